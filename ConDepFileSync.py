@@ -7,71 +7,1048 @@ import cdpwavefile
 import logging
 import logging.handlers
 import time
+import math
+import json
+import hashlib
+import threading
+import Queue
+import fnmatch
+from collections import deque
+import sys
+import errno
+import stat
+import select
+import struct
+import ctypes
+import ctypes.util
+from optparse import OptionParser
 
 #Build a list of filenames in the receiver
 srcFolder = "\\\\cdproaudio2\\xdcache\\CDCutId\\"
 destFolder = "\\CDautoload\\"
 logFileName = "synclog.txt"
+#Transfer metrics, in the Prometheus text format (rewritten after every
+#file) and as one JSON record per line
+metricsFileName = "syncmetrics.prom"
+metricsLogFileName = "syncmetrics.log"
+#How many recent samples the latency percentiles are taken from
+metricsWindow = 1000
+#Upper bounds of the per-file bytes/sec histogram buckets
+rateBuckets = (65536, 262144, 1048576, 4194304, 16777216, 67108864,
+	       268435456)
+#Digest of every delivered file, one "digest *name" line each
+manifestFileName = "syncmanifest.txt"
+digestName = "sha256"
+#Every delivered file as a JSON record, used to skip files delivered
+#before and re-feeds of them under new names
+transferIndexFileName = "synctransfers.jsonl"
+#The fingerprint of a file hashes its size and this many bytes from each
+#end; the head is the first block, which is read anyway
+fingerprintSize = 524288
+#Delete re-fed copies of delivered files from the receiver, as the copy
+#would have; otherwise they are left there
+removeDuplicates = True
+#Replace a different file already in the import folder under the same
+#name instead of logging the conflict and leaving the source alone
+overwriteConflicts = False
+#How much of the end of a leftover .part file is compared with the source
+#before the copy is resumed from there
+resumeVerifySize = 1048576
 
-RXfiles = [] #os.listdir(srcFolder)
-transfer_times = []
-CdpFile = cdpwavefile.CDPFile()
+#Routing rules (a JSON list, see LoadRules) choosing where each file goes
+#from its CartChunk, and where quarantined files are put
+rulesFileName = None
+quarantineFolder = "\\CDautoload\\quarantine\\"
+#CartChunk fields a rule can match, besides the file name
+routeFields = ("cutnum", "title", "artist", "clientid", "category",
+	       "classification", "outcue", "userdef")
+routeActions = ("copy", "quarantine", "skip")
+routeDates = ("current", "future", "expired")
 
-for file in os.listdir(srcFolder):
-    RXfiles.append([file, os.path.getsize(srcFolder + file), tuple(os.stat(srcFolder + file))[7:9]])
-RXfiles = sorted(RXfiles, key=itemgetter(1), reverse=False)
-#print RXfiles
+#Copy block size limits. The block size grows while reads take less than
+#half of targetBlockTime and shrinks while they take more than twice it
+minBlockSize = 65536
+maxBlockSize = 8388608
+targetBlockTime = 0.25
+#Bandwidth cap for reads from the receiver in bytes/sec, shared by all
+#transfers (None for no cap), and (start, end, bytes/sec) local time
+#windows overriding it, e.g. [("07:00", "19:00", 2097152)]
+bandwidthLimit = None
+bandwidthWindows = []
+
+#How many files are copied at once, overall and per SMB share (or drive)
+maxTransfers = 4
+maxTransfersPerShare = 2
+
+#Watch mode: how often to look at the receiver without inotify, how long a
+#file must stop changing before it is copied, and how often to relist the
+#folder anyway in case inotify missed something
+pollInterval = 5.0
+settleTime = 10.0
+rescanInterval = 600.0
+#statfs f_type values of network filesystems (SMB, SMB2, CIFS, NFS), where
+#inotify never sees files written by other hosts, so they are polled
+networkFsTypes = (0x517B, 0xFE534D42, 0xFF534D42, 0x6969)
+
+share_limits = dict()
+share_lock = threading.Lock()
+manifest_lock = threading.Lock()
+#Targets being copied to right now, so two files routed to the same name
+#are never copied over each other
+active_targets = set()
+target_lock = threading.Lock()
+block_sizes = dict()
+block_lock = threading.Lock()
+rules = []
 
-#Set up logging
 my_logger = logging.getLogger('MyLogger')
-my_logger.setLevel(logging.INFO)
-handler = logging.handlers.RotatingFileHandler(
-	logFileName, maxBytes=100000, backupCount=5)
-formatter = logging.Formatter("**%(asctime)s - %(levelname)s--> %(message)s")
-handler.setFormatter(formatter)
-my_logger.addHandler(handler)
-
-my_logger.info('Starting script')
-#print RXfiles
-
-for name, size, times in RXfiles:
-    data = '0'
-    x = open(srcFolder + name, 'rb', 8192)
-    my_logger.debug('Opening source file ' + srcFolder + name)
-    y = open(destFolder + name + ".part", 'wb')
-    my_logger.debug('Opening dest file ' + destFolder + name)
-    start_time = time.clock()
-    data = x.read(524288)
-    CdpFile.SearchWaveDataBlob(data)
-    my_logger.info(CdpFile.cart)
-    my_logger.info(CdpFile.fact)
+metrics_logger = logging.getLogger('MyLogger.metrics')
+metrics_logger.propagate = False
+
+def Percentile(values, fraction):
+    """Return the nearest-rank percentile of a sorted list"""
+    return values[max(0, int(math.ceil(fraction * len(values))) - 1)]
+
+class TransferMetrics:
+    """Class collecting wall-clock transfer statistics. The counters and
+    the histogram cover the whole run; the percentiles are taken from the
+    last metricsWindow samples"""
+    def __init__(self):
+	self.lock = threading.Lock()
+	self.start = time.time()
+	self.files = {"ok": 0, "failed": 0, "skipped": 0}
+	self.errors = dict()
+	self.bytes = 0
+	self.queued = 0
+	self.active = 0
+	self.lastsuccess = 0
+	self.fileseconds = deque(maxlen=metricsWindow)
+	self.filesecondssum = 0.0
+	self.readseconds = deque(maxlen=metricsWindow)
+	self.readsecondssum = 0.0
+	self.readcount = 0
+	self.ratebuckets = [0] * len(rateBuckets)
+	self.ratesum = 0.0
+	self.ratecount = 0
+
+    def Adjust(self, queued=0, active=0):
+	"""Move the queue depth and active transfer gauges"""
+	with self.lock:
+	    self.queued += queued
+	    self.active += active
+
+    def AddRead(self, seconds):
+	"""Record how long one block read from the receiver took"""
+	with self.lock:
+	    self.readseconds.append(seconds)
+	    self.readsecondssum += seconds
+	    self.readcount += 1
+
+    def AddFile(self, name, nbytes, seconds, offset=0):
+	"""Record a delivered file. nbytes is what was actually read from
+	the receiver, so a resumed copy does not count its kept part"""
+	rate = nbytes / seconds if seconds > 0 else 0.0
+	with self.lock:
+	    self.files["ok"] += 1
+	    self.bytes += nbytes
+	    self.lastsuccess = time.time()
+	    self.fileseconds.append(seconds)
+	    self.filesecondssum += seconds
+	    for i, bound in enumerate(rateBuckets):
+		if rate <= bound:
+		    self.ratebuckets[i] += 1
+		    break
+	    self.ratesum += rate
+	    self.ratecount += 1
+	metrics_logger.info(json.dumps({"event": "file", "time": time.time(),
+	    "name": name, "bytes": nbytes, "resumed_at": offset,
+	    "seconds": round(seconds, 6), "bytes_per_second": round(rate, 1)},
+	    sort_keys=True))
+	return rate
+
+    def AddSkip(self, name, reason):
+	"""Record a file that was not copied"""
+	with self.lock:
+	    self.files["skipped"] += 1
+	metrics_logger.info(json.dumps({"event": "skip", "time": time.time(),
+	    "name": name, "reason": reason}, sort_keys=True))
+
+    def AddError(self, name, inst):
+	"""Record a failed transfer"""
+	kind = type(inst).__name__
+	with self.lock:
+	    self.files["failed"] += 1
+	    self.errors[kind] = self.errors.get(kind, 0) + 1
+	metrics_logger.info(json.dumps({"event": "error", "time": time.time(),
+	    "name": name, "type": kind, "message": str(inst)},
+	    sort_keys=True))
+
+    def RunRecord(self):
+	"""Return the totals for the run so far as a dict"""
+	with self.lock:
+	    seconds = time.time() - self.start
+	    return {"event": "run", "time": time.time(),
+		    "files": self.files["ok"], "failed": self.files["failed"],
+		    "bytes": self.bytes, "seconds": round(seconds, 6),
+		    "bytes_per_second": round(self.bytes / seconds, 1)
+		    if seconds > 0 else 0.0}
+
+    def LogRun(self):
+	record = self.RunRecord()
+	my_logger.info('Copied {0} files ({1} failed), {2:1.1f} KB in {3:1.1f}'
+		       ' s, {4:1.3f} KB/s'.format(record["files"],
+		       record["failed"], record["bytes"] / 1024.0,
+		       record["seconds"], record["bytes_per_second"] / 1024))
+	metrics_logger.info(json.dumps(record, sort_keys=True))
+
+    def Summary(self, lines, name, text, samples, total, count):
+	lines.append("# HELP {0} {1}".format(name, text))
+	lines.append("# TYPE {0} summary".format(name))
+	samples = sorted(samples)
+	if samples:
+	    for fraction in (0.5, 0.9, 0.99):
+		lines.append('{0}{{quantile="{1}"}} {2!r}'.format(name,
+			     fraction, Percentile(samples, fraction)))
+	lines.append("{0}_sum {1!r}".format(name, total))
+	lines.append("{0}_count {1}".format(name, count))
+
+    def Write(self, filename):
+	"""Write the metrics in the Prometheus text format. The file is
+	replaced in one step so a collector never reads half of it"""
+	lines = []
+	with self.lock:
+	    now = time.time()
+	    lines.append("# HELP condepsync_files_total Files handled, by"
+			 " result")
+	    lines.append("# TYPE condepsync_files_total counter")
+	    for result in sorted(self.files):
+		lines.append('condepsync_files_total{{result="{0}"}} {1}'
+			     .format(result, self.files[result]))
+	    lines.append("# HELP condepsync_errors_total Failed transfers,"
+			 " by exception type")
+	    lines.append("# TYPE condepsync_errors_total counter")
+	    for kind in sorted(self.errors):
+		lines.append('condepsync_errors_total{{type="{0}"}} {1}'
+			     .format(kind, self.errors[kind]))
+	    lines.append("# HELP condepsync_bytes_total Bytes read from the"
+			 " receiver")
+	    lines.append("# TYPE condepsync_bytes_total counter")
+	    lines.append("condepsync_bytes_total {0}".format(self.bytes))
+	    lines.append("# HELP condepsync_queue_depth Files waiting for a"
+			 " transfer thread")
+	    lines.append("# TYPE condepsync_queue_depth gauge")
+	    lines.append("condepsync_queue_depth {0}".format(self.queued))
+	    lines.append("# HELP condepsync_active_transfers Files being"
+			 " copied")
+	    lines.append("# TYPE condepsync_active_transfers gauge")
+	    lines.append("condepsync_active_transfers {0}".format(self.active))
+	    lines.append("# HELP condepsync_run_seconds Wall time since the"
+			 " run started")
+	    lines.append("# TYPE condepsync_run_seconds gauge")
+	    lines.append("condepsync_run_seconds {0!r}".format(now -
+							       self.start))
+	    lines.append("# HELP condepsync_run_bytes_per_second Bytes read"
+			 " over the wall time of the run")
+	    lines.append("# TYPE condepsync_run_bytes_per_second gauge")
+	    lines.append("condepsync_run_bytes_per_second {0!r}".format(
+			 self.bytes / (now - self.start)))
+	    lines.append("# HELP condepsync_last_success_timestamp_seconds"
+			 " When the last file was delivered")
+	    lines.append("# TYPE condepsync_last_success_timestamp_seconds"
+			 " gauge")
+	    lines.append("condepsync_last_success_timestamp_seconds {0!r}"
+			 .format(self.lastsuccess))
+	    self.Summary(lines, "condepsync_file_seconds", "Wall time to"
+			 " copy one file", self.fileseconds,
+			 self.filesecondssum, self.files["ok"])
+	    self.Summary(lines, "condepsync_read_seconds", "Wall time of one"
+			 " block read from the receiver", self.readseconds,
+			 self.readsecondssum, self.readcount)
+	    lines.append("# HELP condepsync_file_bytes_per_second Per-file"
+			 " copy rate")
+	    lines.append("# TYPE condepsync_file_bytes_per_second histogram")
+	    count = 0
+	    for bound, n in zip(rateBuckets, self.ratebuckets):
+		count += n
+		lines.append('condepsync_file_bytes_per_second_bucket'
+			     '{{le="{0}"}} {1}'.format(bound, count))
+	    lines.append('condepsync_file_bytes_per_second_bucket{{le="+Inf"}}'
+			 ' {0}'.format(self.ratecount))
+	    lines.append("condepsync_file_bytes_per_second_sum {0!r}".format(
+			 self.ratesum))
+	    lines.append("condepsync_file_bytes_per_second_count {0}".format(
+			 self.ratecount))
+	    with open(filename + ".tmp", 'w') as f:
+		f.write("\n".join(lines) + "\n")
+	    if os.name == "nt" and os.path.isfile(filename):
+		os.remove(filename)
+	    os.rename(filename + ".tmp", filename)
+
+metrics = TransferMetrics()
+
+class TransferIndex:
+    """Class remembering every delivered file by name, size and mtime and
+    by fingerprint, kept in a JSON lines file so it outlives the run"""
+    def __init__(self, filename=None):
+	self.filename = filename
+	self.lock = threading.Lock()
+	self.byname = dict()
+	self.byfingerprint = dict()
+	if filename is not None and os.path.isfile(filename):
+	    with open(filename, 'r') as f:
+		for line in f:
+		    try:
+			self.Remember(json.loads(line))
+		    except (ValueError, KeyError, TypeError):
+			#A line cut short when a run was killed
+			pass
+
+    def Remember(self, record):
+	self.byname[(record["name"], record["size"],
+		     record["mtime"])] = record
+	self.byfingerprint[record["fingerprint"]] = record
+
+    def Find(self, name, size, mtime):
+	"""Return the record of the delivery of this very file, or None"""
+	with self.lock:
+	    return self.byname.get((name, size, mtime))
+
+    def FindFingerprint(self, fingerprint):
+	"""Return the record of a delivered file with the same content, or
+	None"""
+	with self.lock:
+	    return self.byfingerprint.get(fingerprint)
+
+    def Add(self, record):
+	with self.lock:
+	    self.Remember(record)
+	    if self.filename is not None:
+		with open(self.filename, 'a') as f:
+		    f.write(json.dumps(record, sort_keys=True) + "\n")
+
+delivered = TransferIndex()
+
+def BandwidthLimit(now=None):
+    """Return the bandwidth cap in effect at now (local time), or None"""
+    clock = time.strftime("%H:%M", time.localtime(now))
+    for start, end, limit in bandwidthWindows:
+	if start <= end:
+	    inwindow = start <= clock < end
+	else:
+	    #The window runs past midnight
+	    inwindow = clock >= start or clock < end
+	if inwindow:
+	    return limit
+    return bandwidthLimit
+
+class TokenBucket:
+    """Class implementing a token bucket shared by every transfer thread.
+    The rate is looked up from BandwidthLimit each time, so a change of
+    window takes effect on the next block. Tokens can go into debt, so a
+    block bigger than the bucket still gets through at the right rate"""
+    def __init__(self):
+	self.lock = threading.Lock()
+	self.tokens = 0.0
+	self.last = time.time()
+
+    def Take(self, nbytes):
+	"""Wait until nbytes may be read"""
+	rate = BandwidthLimit()
+	if not rate:
+	    return
+	with self.lock:
+	    now = time.time()
+	    #Allow a burst of one second's worth
+	    self.tokens = min(float(rate), self.tokens + (now - self.last) *
+			      rate)
+	    self.last = now
+	    self.tokens -= nbytes
+	    wait = -self.tokens / rate
+	if wait > 0:
+	    time.sleep(wait)
+
+bandwidth = TokenBucket()
+
+def ReadBlock(x, size):
+    """Read a block from the receiver, within the bandwidth cap. Returns
+    the data and how long the read itself took"""
+    bandwidth.Take(size)
+    read_time = time.time()
+    data = x.read(size)
+    seconds = time.time() - read_time
+    metrics.AddRead(seconds)
+    return data, seconds
+
+class BlockReader:
+    """Class reading the rest of a file on its own thread, at most two
+    blocks ahead of the writer, so reading from the receiver and writing
+    to the import folder overlap. The block size starts where the last
+    transfer from the same share left it and adapts to how long reads
+    take"""
+    def __init__(self, x, share):
+	self.x = x
+	self.share = share
+	with block_lock:
+	    self.blocksize = block_sizes.get(share, 524288)
+	self.queue = Queue.Queue(maxsize=2)
+	self.stopped = False
+	self.thread = threading.Thread(target=self.Run)
+	self.thread.setDaemon(True)
+	self.thread.start()
+
+    def Run(self):
+	try:
+	    while not self.stopped:
+		rate = BandwidthLimit()
+		size = self.blocksize
+		if rate:
+		    #Keep a block to about a second at the capped rate
+		    size = max(minBlockSize, min(size, int(rate)))
+		data, seconds = ReadBlock(self.x, size)
+		if data == '':
+		    break
+		if len(data) == size:
+		    self.Tune(size, seconds)
+		self.queue.put(data)
+	except Exception as inst:
+	    self.queue.put(inst)
+	    return
+	self.queue.put('')
+
+    def Tune(self, size, seconds):
+	if seconds < targetBlockTime / 2 and size < maxBlockSize:
+	    self.blocksize = min(maxBlockSize, size * 2)
+	elif seconds > targetBlockTime * 2 and size > minBlockSize:
+	    self.blocksize = max(minBlockSize, size // 2)
+
+    def Next(self):
+	"""Return the next block, or '' at the end of the file"""
+	data = self.queue.get()
+	if isinstance(data, Exception):
+	    raise data
+	return data
+
+    def Stop(self):
+	"""Stop reading, even if the writer gave up part way"""
+	self.stopped = True
+	while self.thread.isAlive():
+	    try:
+		self.queue.get(timeout=0.1)
+	    except Queue.Empty:
+		pass
+	with block_lock:
+	    block_sizes[self.share] = self.blocksize
+
+def ShareName(path):
+    """Return the \\\\server\\share or drive a path lives on"""
+    path = os.path.normcase(os.path.abspath(path))
+    if path.startswith("\\\\"):
+	return "\\".join(path.split("\\")[:4])
+    drive, rest = os.path.splitdrive(path)
+    return drive or os.sep
+
+def ShareSemaphores(*paths):
+    """Return the semaphores limiting transfers on the shares of paths,
+    one per share, in a fixed order so they can be taken without
+    deadlocking"""
+    semaphores = []
+    with share_lock:
+	for share in sorted(set(ShareName(path) for path in paths)):
+	    if share not in share_limits:
+		share_limits[share] = threading.BoundedSemaphore(
+		    maxTransfersPerShare)
+	    semaphores.append(share_limits[share])
+    return semaphores
+
+def ListReceiverFiles(folder):
+    """Return [name, size, (atime, mtime)] for each file in folder, smallest
+    first"""
+    RXfiles = []
+    for file in os.listdir(folder):
+	RXfiles.append([file, os.path.getsize(folder + file), tuple(os.stat(folder + file))[7:9]])
+    return sorted(RXfiles, key=itemgetter(1), reverse=False)
+
+def LoadRules(filename):
+    """Read the routing rules, a JSON list tried in order until one matches:
+
+    [{"match": {"category": "NEWS*", "dates": "expired"}, "action": "skip"},
+     {"match": {"clientid": ["NPR*", "PRI*"]}, "folder": "D:/autoload/npr/",
+      "rename": "{cutnum}{ext}"},
+     {"match": {"cutnum": ""}, "action": "quarantine"}]
+
+    match patterns are fnmatch patterns compared without regard to case
+    with the CartChunk fields in routeFields or the file name ("name"); a
+    list matches if any pattern does. "dates" compares the CartChunk start
+    and end date and time with now. action is copy (the default),
+    quarantine or skip. rename is formatted with the CartChunk fields,
+    name, base and ext"""
+    with open(filename, 'r') as f:
+	loaded = json.load(f)
+    if not isinstance(loaded, list):
+	raise ValueError("{0}: the rules must be a JSON list".format(filename))
+    dummy = dict((field, "") for field in routeFields + ("name", "base",
+							 "ext"))
+    for number, rule in enumerate(loaded):
+	where = "{0}: rule {1}".format(filename, number + 1)
+	if not isinstance(rule, dict):
+	    raise ValueError("{0}: each rule must be a JSON object".format(
+			     where))
+	match = rule.get("match", dict())
+	for field in match:
+	    if field not in routeFields + ("name", "dates"):
+		raise ValueError("{0}: cannot match on '{1}'".format(where,
+								     field))
+	if "dates" in match and match["dates"] not in routeDates:
+	    raise ValueError("{0}: dates must be one of {1}".format(where,
+			     ", ".join(routeDates)))
+	if rule.get("action", "copy") not in routeActions:
+	    raise ValueError("{0}: action must be one of {1}".format(where,
+			     ", ".join(routeActions)))
+	if "rename" in rule:
+	    try:
+		rule["rename"].format(**dummy)
+	    except (KeyError, IndexError, ValueError) as inst:
+		raise ValueError("{0}: bad rename pattern: {1}".format(where,
+								      inst))
+    return loaded
+
+def RouteFile(CdpFile, foundchunks, name):
+    """Pick the first rule matching the CartChunk decoded from the head of
+    a file. Returns (action, folder, new name, rule number), rule number
+    being None when no rule matched"""
+    if "cart" in foundchunks:
+	fields = dict((field, str(getattr(CdpFile.cart, field)).strip())
+		      for field in routeFields)
+    else:
+	fields = dict((field, "") for field in routeFields)
+    fields["name"] = name
+    now = time.strftime("%Y/%m/%d %H:%M:%S")
+    for number, rule in enumerate(rules):
+	matched = True
+	for field, patterns in rule.get("match", dict()).items():
+	    if field == "dates":
+		if "cart" not in foundchunks:
+		    matched = False
+		    break
+		start = CdpFile.cart.startdate + " " + CdpFile.cart.starttime
+		end = CdpFile.cart.enddate + " " + CdpFile.cart.endtime
+		window = ("future" if now < start else "expired" if end < now
+			  else "current")
+		matched = patterns == window
+	    else:
+		if not isinstance(patterns, list):
+		    patterns = [patterns]
+		matched = any(fnmatch.fnmatchcase(fields[field].lower(),
+			      pattern.lower()) for pattern in patterns)
+	    if not matched:
+		break
+	if not matched:
+	    continue
+	action = rule.get("action", "copy")
+	folder = rule.get("folder", quarantineFolder if action ==
+			  "quarantine" else destFolder)
+	newname = name
+	if "rename" in rule:
+	    #Keep the values from making paths or illegal file names
+	    values = dict((field, "".join("_" if c in '\\/:*?"<>|' or
+			  c < " " else c for c in value))
+			  for field, value in fields.items())
+	    values["base"], values["ext"] = os.path.splitext(name)
+	    newname = rule["rename"].format(**values).strip() or name
+	return action, folder, newname, number + 1
+    return "copy", destFolder, name, None
+
+def Fingerprint(x, firstblock, size):
+    """Return a quick fingerprint of an open file from its size, the block
+    already read from its head and its last fingerprintSize bytes"""
+    fingerprint = hashlib.new(digestName, str(size))
+    fingerprint.update(firstblock[:fingerprintSize])
+    if size > fingerprintSize:
+	x.seek(max(fingerprintSize, size - fingerprintSize))
+	fingerprint.update(ReadBlock(x, fingerprintSize)[0])
+	x.seek(len(firstblock))
+    return fingerprint.hexdigest()
+
+def ContentDigest(x, firstblock):
+    """Return the digest of the whole of an open file from the block
+    already read from its head and the rest of the file. The file is left
+    just after that block"""
+    digest = hashlib.new(digestName, firstblock)
+    data = ReadBlock(x, 524288)[0]
     while data != '':
-	y.write(data)
-	#time.sleep(0.1)
-	elapsed_time = time.clock() - start_time
-	transfer_times.append((elapsed_time, len(data)))
-	start_time = time.clock()
-	data = x.read(524288)
-    x.close()
-    y.close()
+	digest.update(data)
+	data = ReadBlock(x, 524288)[0]
+    x.seek(len(firstblock))
+    return digest.hexdigest()
+
+def DropDuplicate(name, record):
+    """Deal with a receiver file that was delivered before as record.
+    Returns the digest of the delivered file if the duplicate was removed,
+    or None if it was left on the receiver"""
+    if record["name"] == name:
+	reason = "delivered {0}".format(time.strftime("%Y/%m/%d %H:%M:%S",
+					time.localtime(record["time"])))
+    else:
+	reason = "re-feed of {0}".format(record["name"])
+    my_logger.info('Not copying {0}: {1} as {2}'.format(name, reason,
+							record["target"]))
+    metrics.AddSkip(name, reason)
+    if not removeDuplicates:
+	return None
+    os.unlink(srcFolder + name)
+    return record["digest"]
+
+def ResumeOffset(x, firstblock, partname, size):
+    """Return how many bytes of a leftover .part file can be kept. The
+    part must match the block already read from the source and the last
+    resumeVerifySize bytes it shares with the source. If the part cannot
+    be kept, the source is left just after the block already read"""
+    partsize = os.path.getsize(partname)
+    overlap = min(partsize, size)
+    with open(partname, 'rb') as y:
+	head = min(overlap, len(firstblock))
+	if y.read(head) != firstblock[:head]:
+	    return 0
+	window = min(resumeVerifySize, overlap - head)
+	if window > 0:
+	    x.seek(overlap - window)
+	    y.seek(overlap - window)
+	    if (hashlib.new(digestName, x.read(window)).digest() !=
+		    hashlib.new(digestName, y.read(window)).digest()):
+		x.seek(len(firstblock))
+		return 0
+    return overlap
+
+def ClaimTarget(target):
+    """Mark target as being copied to. Returns False if another transfer
+    already has it"""
+    with target_lock:
+	if target in active_targets:
+	    return False
+	active_targets.add(target)
+	return True
+
+def TransferFile(name, size, times):
+    """Copy one file from the receiver to the folder its routing rule
+    picks, resuming a leftover .part file if it matches the source, and
+    return the digest of the copied data, or None if the file was left on
+    the receiver. Files delivered before are not copied again"""
+    claimed = []
+    try:
+	return DeliverFile(name, size, times, claimed)
+    finally:
+	with target_lock:
+	    active_targets.difference_update(claimed)
+
+def DeliverFile(name, size, times, claimed):
+    """Do the work of TransferFile, adding the target it claims to the
+    claimed list"""
+    #The receiver share is taken first and the destination share only
+    #once the file is routed, so no transfer waits for the receiver share
+    #while holding another one
+    semaphores = ShareSemaphores(srcFolder)
+    for semaphore in semaphores:
+	semaphore.acquire()
+    try:
+	start_time = time.time()
+	CdpFile = cdpwavefile.CDPFile()
+	digest = hashlib.new(digestName)
+	#Reads are in big blocks, so buffering would only add a copy
+	with open(srcFolder + name, 'rb', 0) as x:
+	    my_logger.debug('Opening source file ' + srcFolder + name)
+	    data = ReadBlock(x, 524288)[0]
+	    fingerprint = Fingerprint(x, data, size)
+	    #A delivery with the same name, size and time or the same
+	    #fingerprint is only a candidate; the digest of the whole file
+	    #shows whether it really was delivered
+	    candidates = [record for record in (delivered.Find(name, size,
+			  times[1]), delivered.FindFingerprint(fingerprint))
+			  if record is not None]
+	    if candidates:
+		contentdigest = ContentDigest(x, data)
+		for duplicate in candidates:
+		    if duplicate["digest"] == contentdigest:
+			x.close()
+			return DropDuplicate(name, duplicate)
+		my_logger.info('{0} looks like {1} delivered before but has'
+			       ' other content, copying it'.format(name,
+			       candidates[0]["name"]))
+	    foundchunks = CdpFile.SearchWaveDataBlob(data)
+	    my_logger.info(CdpFile.cart)
+	    my_logger.info(CdpFile.fact)
+	    action, folder, newname, rule = RouteFile(CdpFile, foundchunks,
+						      name)
+	    if action == "skip":
+		my_logger.info('Skipping {0} (rule {1})'.format(name, rule))
+		metrics.AddSkip(name, "rule {0}".format(rule))
+		return None
+	    for semaphore in ShareSemaphores(folder):
+		if semaphore not in semaphores:
+		    semaphore.acquire()
+		    semaphores.append(semaphore)
+	    if action == "quarantine":
+		my_logger.warn('Quarantining {0} in {1} (rule {2})'.format(
+			       name, folder, rule))
+	    elif rule is not None:
+		my_logger.info('Routing {0} to {1}{2} (rule {3})'.format(name,
+			       folder, newname, rule))
+	    target = folder + newname
+	    if not ClaimTarget(target):
+		my_logger.error('Conflict: {0} is being copied from another'
+				' file, leaving {1} on the receiver'.format(
+				target, name))
+		metrics.AddSkip(name, "conflict with {0}".format(target))
+		return None
+	    claimed.append(target)
+	    if os.path.isfile(target) and not overwriteConflicts:
+		my_logger.error('Conflict: {0} already exists, leaving {1}'
+				' on the receiver'.format(target, name))
+		metrics.AddSkip(name, "conflict with {0}".format(target))
+		return None
+	    #A renamed file gets a part of its own, so a part is only
+	    #ever resumed by the file it came from
+	    if newname == name:
+		partname = target + ".part"
+	    else:
+		partname = "{0}.{1}.part".format(target, name)
+	    offset = 0
+	    if os.path.isfile(partname):
+		offset = ResumeOffset(x, data, partname, size)
+	    with open(partname, 'r+b' if offset else 'wb') as y:
+		my_logger.debug('Opening dest file ' + target)
+		if offset:
+		    my_logger.info('Resuming {0} at byte {1}'.format(name,
+								     offset))
+		    #The kept part still has to go into the digest, but
+		    #that is a local read
+		    y.seek(0)
+		    while y.tell() < offset:
+			digest.update(y.read(min(524288, offset - y.tell())))
+		    y.truncate(offset)
+		    y.seek(offset)
+		    if offset < len(data):
+			data = data[offset:]
+			x.seek(offset + len(data))
+		    else:
+			x.seek(offset)
+			data = ReadBlock(x, 524288)[0]
+		reader = BlockReader(x, ShareName(srcFolder))
+		try:
+		    while data != '':
+			digest.update(data)
+			y.write(data)
+			data = reader.Next()
+		finally:
+		    reader.Stop()
+		copied = y.tell()
+	    elapsed_time = time.time() - start_time
+    finally:
+	for semaphore in reversed(semaphores):
+	    semaphore.release()
     my_logger.debug('Done copying ' + destFolder + name)
-    if os.path.isfile(destFolder + name):
-	my_logger.warn("Overwriting file " + destFolder + name)
-	os.remove(destFolder + name)
-    os.rename(destFolder + name + ".part",
-	      destFolder + name )
-    os.utime(destFolder + name, times)
+    st = tuple(os.stat(srcFolder + name))
+    if copied != size or st[6] != size or st[8] != times[1]:
+	#Keep the source and the .part; the next run resumes from it
+	raise IOError("{0} changed while it was copied".format(name))
+    if os.path.isfile(target):
+	if not overwriteConflicts:
+	    raise IOError("{0} appeared while {1} was copied".format(target,
+								     name))
+	my_logger.warn("Overwriting file " + target)
+	os.remove(target)
+    os.rename(partname, target)
+    os.utime(target, times)
     os.unlink(srcFolder + name)
-    my_logger.info('Copied {0:1.1f} KB file'.format(os.stat(
-                      destFolder + name).st_size / 1024))
+    rate = metrics.AddFile(name, copied - offset, elapsed_time, offset)
+    my_logger.info('Copied {0:1.1f} KB file in {1:1.2f} s, {2:1.3f} KB/s, {3}'
+		   ' {4}'.format(os.stat(target).st_size / 1024,
+		   elapsed_time, rate / 1024, digestName, digest.hexdigest()))
+    with manifest_lock:
+	with open(manifestFileName, 'a') as m:
+	    m.write("{0} *{1}\n".format(digest.hexdigest(), newname if
+		    folder == destFolder else target))
+    delivered.Add({"name": name, "size": size, "mtime": times[1],
+		   "digest": digest.hexdigest(), "fingerprint": fingerprint,
+		   "target": target, "time": time.time()})
+    return digest.hexdigest()
+
+class TransferPool:
+    """Class running TransferFile on a fixed number of threads. Files are
+    copied in the order they are submitted, and (name, succeeded) is put
+    on the finished queue as each one is done, succeeded being None for a
+    file a routing rule skipped"""
+    def __init__(self, workers=maxTransfers):
+	self.queue = Queue.Queue()
+	self.finished = Queue.Queue()
+	self.threads = []
+	for i in range(workers):
+	    thread = threading.Thread(target=self.Worker)
+	    thread.setDaemon(True)
+	    thread.start()
+	    self.threads.append(thread)
+
+    def Worker(self):
+	while True:
+	    job = self.queue.get()
+	    try:
+		if job is None:
+		    return
+		metrics.Adjust(queued=-1, active=1)
+		try:
+		    digest = TransferFile(*job)
+		    self.finished.put((job[0], None if digest is None
+				       else True))
+		except Exception as inst:
+		    my_logger.error('Transfer of {0} failed: {1}'.format(
+			job[0], inst))
+		    metrics.AddError(job[0], inst)
+		    self.finished.put((job[0], False))
+		metrics.Adjust(active=-1)
+		try:
+		    metrics.Write(metricsFileName)
+		except (IOError, OSError) as inst:
+		    my_logger.error('Could not write metrics: {0}'.format(
+			inst))
+	    finally:
+		self.queue.task_done()
+
+    def Submit(self, name, size, times):
+	metrics.Adjust(queued=1)
+	self.queue.put((name, size, times))
+
+    def Join(self):
+	"""Wait for every submitted file to be copied"""
+	self.queue.join()
+
+    def Stop(self):
+	for thread in self.threads:
+	    self.queue.put(None)
+	for thread in self.threads:
+	    thread.join()
+
+class InotifyWatch:
+    """Class wrapping a Linux inotify watch on one folder through ctypes"""
+    IN_MODIFY = 0x002
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+
+    def __init__(self, folder):
+	libcname = ctypes.util.find_library("c")
+	if not sys.platform.startswith("linux") or libcname is None:
+	    raise OSError(errno.ENOSYS, "inotify is not available")
+	libc = ctypes.CDLL(libcname, use_errno=True)
+	#struct statfs starts with the f_type word
+	buf = ctypes.create_string_buffer(256)
+	if (libc.statfs(folder, buf) == 0 and ctypes.cast(buf,
+		ctypes.POINTER(ctypes.c_long))[0] & 0xFFFFFFFF in
+		networkFsTypes):
+	    raise OSError(errno.EREMOTE, "inotify does not see changes"
+			  " made by other hosts on a network share")
+	self.fd = libc.inotify_init()
+	if self.fd < 0:
+	    raise OSError(ctypes.get_errno(), "inotify_init failed")
+	mask = (self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM |
+		self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE)
+	if libc.inotify_add_watch(self.fd, folder, mask) < 0:
+	    err = ctypes.get_errno()
+	    os.close(self.fd)
+	    raise OSError(err, "inotify_add_watch failed on " + folder)
+
+    def Wait(self, timeout):
+	"""Wait up to timeout seconds for changes. Returns the set of file
+	names that changed, or None if events were lost"""
+	names = set()
+	ready, w, x = select.select([self.fd], [], [], timeout)
+	if not ready:
+	    return names
+	events = os.read(self.fd, 65536)
+	ptr = 0
+	while ptr + 16 <= len(events):
+	    wd, mask, cookie, namelen = struct.unpack_from("iIII", events, ptr)
+	    ptr += 16
+	    if mask & self.IN_Q_OVERFLOW:
+		return None
+	    names.add(events[ptr:ptr + namelen].rstrip("\x00"))
+	    ptr += namelen
+	return names
+
+    def Close(self):
+	os.close(self.fd)
+
+class FolderWatcher:
+    """Class keeping an in-memory view of the receiver folder and handing
+    each file to a TransferPool once it has stopped growing"""
+    def __init__(self, folder, pool):
+	self.folder = folder
+	self.pool = pool
+	#name -> [size, times, time of last change, queued], queued being
+	#None for a file skipped by a routing rule until it changes
+	self.files = dict()
+	try:
+	    self.inotify = InotifyWatch(folder)
+	    my_logger.info('Watching {0} with inotify'.format(folder))
+	except (OSError, AttributeError) as inst:
+	    self.inotify = None
+	    my_logger.info('Polling {0} every {1} seconds ({2})'.format(
+		folder, pollInterval, inst))
+
+    def Stat(self, name, now):
+	try:
+	    st = os.stat(self.folder + name)
+	except OSError:
+	    #Gone, most likely copied and unlinked
+	    if name in self.files and not self.files[name][3]:
+		del self.files[name]
+	    return
+	if not stat.S_ISREG(st.st_mode):
+	    #Folders and the like are never copied
+	    return
+	size, times = st.st_size, tuple(st)[7:9]
+	entry = self.files.get(name)
+	if entry is None:
+	    self.files[name] = [size, times, now, False]
+	elif (size, times) != (entry[0], entry[1]):
+	    entry[0:3] = [size, times, now]
+	    if entry[3] is None:
+		entry[3] = False
+
+    def Rescan(self, now):
+	names = set(os.listdir(self.folder))
+	for name in names:
+	    self.Stat(name, now)
+	for name in list(self.files):
+	    if name not in names and not self.files[name][3]:
+		del self.files[name]
+
+    def Run(self):
+	now = time.time()
+	self.Rescan(now)
+	lastrescan = now
+	while True:
+	    if self.inotify is not None:
+		names = self.inotify.Wait(min(pollInterval, settleTime))
+		now = time.time()
+		if names is None or now - lastrescan >= rescanInterval:
+		    self.Rescan(now)
+		    lastrescan = now
+		else:
+		    for name in names:
+			self.Stat(name, now)
+	    else:
+		time.sleep(pollInterval)
+		now = time.time()
+		self.Rescan(now)
+	    while True:
+		try:
+		    name, succeeded = self.pool.finished.get_nowait()
+		except Queue.Empty:
+		    break
+		if name in self.files:
+		    if succeeded is None:
+			self.files[name][3] = None
+		    elif succeeded:
+			del self.files[name]
+		    else:
+			#Try again once it has been left alone for a while
+			self.files[name][2:4] = [now, False]
+	    for name, entry in sorted(self.files.items(),
+				      key=lambda item: item[1][0]):
+		if entry[3] is False and now - entry[2] >= settleTime:
+		    my_logger.debug('Queueing ' + name)
+		    self.pool.Submit(name, entry[0], entry[1])
+		    entry[3] = True
+
+parser = OptionParser(usage="usage: %prog [options]")
+parser.add_option("-w", "--watch", dest="watch", action="store_true",
+	default=False,
+	help="keep running and copy files as soon as they stop growing")
+parser.add_option("-r", "--rules", dest="rules_file", default=rulesFileName,
+	help="route files by their CartChunk with the JSON rules in FILE",
+	metavar="FILE")
+parser.add_option("--bwlimit", dest="bwlimit", type="float",
+	help="cap reads from the receiver at KBPS kilobytes per second",
+	metavar="KBPS")
+parser.add_option("--bwwindow", dest="bwwindows", action="append",
+	default=[], help="cap reads at KBPS kilobytes per second between"
+	" the local times START and END (HH:MM), may be given more than"
+	" once", metavar="START-END=KBPS")
+parser.add_option("--poll-interval", dest="poll_interval", type="float",
+	default=pollInterval,
+	help="seconds between folder checks when inotify is not available,"
+	" default value is {0}".format(pollInterval), metavar="SECONDS")
+parser.add_option("--settle-time", dest="settle_time", type="float",
+	default=settleTime,
+	help="seconds a file must stay unchanged before it is copied in"
+	" watch mode, default value is {0}".format(settleTime),
+	metavar="SECONDS")
+
+def main():
+    global pollInterval, settleTime, rules, delivered, bandwidthLimit
+    (options, args) = parser.parse_args()
+    if options.bwlimit is not None:
+	bandwidthLimit = options.bwlimit * 1024 or None
+    for window in options.bwwindows:
+	try:
+	    times, limit = window.split("=")
+	    #Stored as HH:MM so they compare with the clock as strings
+	    start, end = (time.strftime("%H:%M", time.strptime(clock,
+			  "%H:%M")) for clock in times.split("-"))
+	    bandwidthWindows.append((start, end, float(limit) * 1024))
+	except ValueError:
+	    parser.error("Bad bandwidth window '{0}', should be"
+			 " HH:MM-HH:MM=KBPS".format(window))
+    if options.rules_file is not None:
+	try:
+	    rules = LoadRules(options.rules_file)
+	except (IOError, ValueError) as inst:
+	    parser.error("Could not load the routing rules: {0}".format(inst))
+    pollInterval = options.poll_interval
+    settleTime = options.settle_time
+
+    #Set up logging
+    my_logger.setLevel(logging.INFO)
+    handler = logging.handlers.RotatingFileHandler(
+	    logFileName, maxBytes=100000, backupCount=5)
+    formatter = logging.Formatter("**%(asctime)s - %(levelname)s--> %(message)s")
+    handler.setFormatter(formatter)
+    my_logger.addHandler(handler)
+    handler = logging.handlers.RotatingFileHandler(
+	    metricsLogFileName, maxBytes=1000000, backupCount=5)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    metrics_logger.addHandler(handler)
+
+    my_logger.info('Starting script')
+    delivered = TransferIndex(transferIndexFileName)
+    if options.watch:
+	pool = TransferPool(maxTransfers)
+	try:
+	    FolderWatcher(srcFolder, pool).Run()
+	except KeyboardInterrupt:
+	    my_logger.info('Stopping watch, waiting for copies to finish')
+	    pool.Join()
+	    pool.Stop()
+	metrics.LogRun()
+	metrics.Write(metricsFileName)
+	my_logger.info('End of script')
+	return
+
+    RXfiles = ListReceiverFiles(srcFolder)
+    #print RXfiles
+
+    pool = TransferPool(maxTransfers)
+    for name, size, times in RXfiles:
+	pool.Submit(name, size, times)
+    pool.Join()
+    pool.Stop()
 
-#print transfer_times
-avg_transfer_rate = 0
-for datapoints in transfer_times:
-    avg_transfer_rate = (avg_transfer_rate + (datapoints[1] / datapoints[0]) ) / 2
+    metrics.LogRun()
+    metrics.Write(metricsFileName)
 
-#print avg_transfer_rate / 1024
-if len( transfer_times ) > 0:
-    my_logger.info('Avg transfer rate: {0:1.3f} KB/s'.format(avg_transfer_rate / 1024))
+    my_logger.info('End of script')
 
-my_logger.info('End of script')
+if __name__ == "__main__":
+    main()
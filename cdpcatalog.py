@@ -0,0 +1,230 @@
+#!/usr/bin/python
+
+#===============================================================
+#  cdpcatalog.py - A persistent SQLite catalog of the headers of
+#  CartChunk'ed BWF files. Rescans only re-read files whose size,
+#  modification time or inode changed since the last scan.
+#  Uses the cdpwavefile.py library functions
+#
+#===============================================================
+#
+#===============================================================
+#License (see the MIT License)
+#
+#Copyright (c) 2010 John McMellen
+#
+#Permission is hereby granted, free of charge, to any person
+#obtaining a copy of this software and associated documentation
+#files (the "Software"), to deal in the Software without
+#restriction, including without limitation the rights to use,
+#copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the
+#Software is furnished to do so, subject to the following
+#conditions:
+#
+#The above copyright notice and this permission notice shall be
+#included in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+#OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+#HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+#WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#OTHER DEALINGS IN THE SOFTWARE.
+#
+#=================================================================
+
+from cdpwavefile import *
+from optparse import OptionParser
+import sys
+import time
+import fnmatch
+import sqlite3
+
+program_version = "1.0"
+
+#CartChunk fields copied into their own columns so they can be queried
+catalogcartfields = ("cutnum", "title", "artist", "clientid", "category",
+		     "classification", "startdate", "starttime", "enddate",
+		     "endtime")
+
+class CDPCatalog:
+    """Class implementing a catalog of wave file headers kept in SQLite"""
+    def __init__(self, dbfilename):
+	self.db = sqlite3.connect(dbfilename)
+	self.db.text_factory = str
+	self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+	    path TEXT PRIMARY KEY, size INTEGER, mtime REAL, inode INTEGER,
+	    scan INTEGER, error TEXT, audiopointer INTEGER,
+	    datasize INTEGER, {0})""".format(
+	    ", ".join(field + " TEXT" for field in catalogcartfields)))
+	self.db.execute("""CREATE TABLE IF NOT EXISTS chunks (
+	    path TEXT, chunktype TEXT, offset INTEGER, size INTEGER,
+	    data BLOB)""")
+	self.db.execute("CREATE INDEX IF NOT EXISTS chunks_path "
+			"ON chunks (path)")
+	self.db.execute("CREATE INDEX IF NOT EXISTS files_cutnum "
+			"ON files (cutnum)")
+	self.db.execute("CREATE INDEX IF NOT EXISTS files_enddate "
+			"ON files (enddate, endtime)")
+	self.db.commit()
+
+    def Close(self):
+	self.db.close()
+
+    def Scan(self, paths, pattern="*.wav"):
+	"""Bring the catalog up to date with the wave files in the given
+	folders (searched recursively) and files. Files that vanished from
+	a scanned folder are dropped. Returns (seen, reread, dropped)"""
+	scan = int(time.time() * 1000)
+	seen = reread = dropped = 0
+	try:
+	    for path in paths:
+		if os.path.isdir(path):
+		    for dirpath, dirnames, filenames in os.walk(path):
+			for filename in filenames:
+			    if fnmatch.fnmatch(filename.lower(),
+					       pattern.lower()):
+				seen += 1
+				try:
+				    if self.UpdateFile(os.path.join(dirpath,
+					    filename), scan):
+					reread += 1
+				except OSError:
+				    #The file went away while scanning
+				    pass
+		    folder = os.path.join(path, "")
+		    self.db.execute("DELETE FROM chunks WHERE path IN "
+			"(SELECT path FROM files WHERE scan != ? AND "
+			"substr(path, 1, ?) = ?)", (scan, len(folder), folder))
+		    dropped += self.db.execute("DELETE FROM files WHERE "
+			"scan != ? AND substr(path, 1, ?) = ?",
+			(scan, len(folder), folder)).rowcount
+		elif os.path.isfile(path):
+		    seen += 1
+		    if self.UpdateFile(path, scan):
+			reread += 1
+	    self.db.commit()
+	except:
+	    self.db.rollback()
+	    raise
+	return seen, reread, dropped
+
+    def UpdateFile(self, filename, scan=0):
+	"""Re-read the headers of one file if it changed since it was last
+	cataloged. Returns True if the file was read"""
+	st = os.stat(filename)
+	row = self.db.execute("SELECT size, mtime, inode FROM files "
+			      "WHERE path = ?", (filename,)).fetchone()
+	if row is not None and tuple(row) == (st.st_size, st.st_mtime,
+					      st.st_ino):
+	    self.db.execute("UPDATE files SET scan = ? WHERE path = ?",
+			    (scan, filename))
+	    return False
+	#Only the cart fields that get columns are decoded
+	view = HeaderView(filename, [], 0, 0, dict())
+	error = None
+	cartfields = (None,) * len(catalogcartfields)
+	try:
+	    view = ReadHeaderView(filename)
+	    if view.cart is not None:
+		cartfields = tuple(getattr(view.cart, field)
+				   for field in catalogcartfields)
+	except Exception as inst:
+	    error = "{0}: {1}".format(type(inst).__name__, inst)
+	self.db.execute("DELETE FROM chunks WHERE path = ?", (filename,))
+	self.db.execute("INSERT OR REPLACE INTO files VALUES "
+	    "(?, ?, ?, ?, ?, ?, ?, ?, {0})".format(
+	    ", ".join("?" * len(catalogcartfields))),
+	    (filename, st.st_size, st.st_mtime, st.st_ino, scan, error,
+	     view.audiopointer or 0, view.datasize or 0) + cartfields)
+	for chunktype, offset, chunksize in view.chunkmap:
+	    data = view.raw.get(chunktype.rstrip())
+	    if data is not None:
+		data = sqlite3.Binary(data)
+	    self.db.execute("INSERT INTO chunks VALUES (?, ?, ?, ?, ?)",
+			    (filename, chunktype, offset, chunksize, data))
+	return True
+
+    def LoadCDPFile(self, filename):
+	"""Return a CDPFile filled in from the catalog without reading the
+	wave file, or None if the file is not cataloged"""
+	row = self.db.execute("SELECT audiopointer, datasize FROM files "
+			      "WHERE path = ?", (filename,)).fetchone()
+	if row is None:
+	    return None
+	MyCDPFile = CDPFile()
+	MyCDPFile.audiopointer, MyCDPFile.datasize = row
+	MyCDPFile.audiosrcfilename = filename
+	rawchunks = dict()
+	for chunktype, offset, chunksize, data in self.db.execute(
+		"SELECT chunktype, offset, size, data FROM chunks "
+		"WHERE path = ? ORDER BY offset", (filename,)):
+	    MyCDPFile.chunkmap.append((chunktype, offset, chunksize))
+	    if data is not None:
+		rawchunks[chunktype.rstrip()] = str(data)
+	MyCDPFile.DecodeRawChunks(rawchunks)
+	return MyCDPFile
+
+    def ExpiredCuts(self, now=None):
+	"""Return (path, cutnum, enddate, endtime) for every cut whose
+	CartChunk end date and time has passed"""
+	if now is None:
+	    now = time.localtime()
+	return self.db.execute("SELECT path, cutnum, enddate, endtime FROM "
+	    "files WHERE enddate || ' ' || endtime < ? ORDER BY enddate, "
+	    "endtime", (time.strftime("%Y/%m/%d %H:%M:%S", now),)).fetchall()
+
+    def FilesByCutnum(self, cutnum):
+	"""Return the paths of every file with the given CartChunk cutnum"""
+	return [row[0] for row in self.db.execute("SELECT path FROM files "
+	    "WHERE cutnum = ? ORDER BY path", (cutnum,))]
+
+parser = OptionParser(usage="usage: %prog [options] catalogfile [FOLDER/FILE...]")
+parser.add_option("-v", "--ver", dest="show_version",
+	action="store_true", default=False,
+	help="show program version")
+parser.add_option("--pattern", dest="pattern", default="*.wav",
+	help="only catalog files in folders matching PATTERN, default"
+	" value is *.wav")
+parser.add_option("--expired", dest="show_expired", action="store_true",
+	default=False, help="list the cuts whose end date has passed")
+parser.add_option("-c", "--cutnum", dest="cutnum",
+	help="list the files with CartChunk Cutnum CUTNUM")
+
+def main():
+    if options.show_version:
+	print "Cdpcatalog Version {0}/Core version {1}".format(program_version,
+		cdpwavefile_core_version)
+	if len(args) == 0:
+	    sys.exit()
+    if len(args) == 0:
+	parser.error("Catalog file not specified. Try {0} -h for detailed"
+		" help.".format(os.path.basename(sys.argv[0])))
+    catalog = CDPCatalog(args[0])
+    try:
+	if len(args) > 1:
+	    seen, reread, dropped = catalog.Scan(args[1:], options.pattern)
+	    print "Scanned {0} files, read {1}, dropped {2}".format(seen,
+		    reread, dropped)
+	if options.show_expired:
+	    for path, cutnum, enddate, endtime in catalog.ExpiredCuts():
+		print "{0}\t{1}\t{2} {3}".format(cutnum, path, enddate,
+			endtime)
+	if options.cutnum is not None:
+	    for path in catalog.FilesByCutnum(options.cutnum):
+		print path
+    except (IOError, OSError) as inst:
+	print "An IO error occurred"
+	print inst
+    except sqlite3.Error as inst:
+	print "A catalog error occurred"
+	print inst
+    finally:
+	catalog.Close()
+
+if __name__ == "__main__":
+    (options, args) = parser.parse_args()
+    main()
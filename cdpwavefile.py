@@ -29,12 +29,115 @@
 #=================================================================
 
 from struct import *
-from xml.dom.minidom import parse, parseString, getDOMImplementation
+from array import array
+from operator import attrgetter
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
 import re
 import os.path
+import json
+import errno
+import mmap
+import tempfile
+try:
+    import numpy
+    from numpy.lib.stride_tricks import as_strided
+except ImportError:
+    numpy = None
 
 cdpwavefile_core_version = 1.6
 
+#Strategies understood by CopyAudioData. "auto" tries the kernel-side copies
+#first and drops back to buffered reads when the filesystem refuses them.
+copymethods = ("auto", "copy_file_range", "sendfile", "readinto")
+copybuffersize = 1048576
+
+#Filler chunks that UpdateHeadersInPlace may grow a header chunk into
+junkchunks = ("JUNK", "junk", "PAD ", "FLLR")
+#Header chunks CDPFile decodes
+headerchunks = ("fmt", "fact", "mext", "bext", "cart")
+#NumPy types of the struct codes used in the chunk schemas
+structdtypes = {"B": "u1", "H": "<u2", "L": "<u4", "I": "<u4", "h": "<i2",
+		"i": "<i4", "l": "<i4", "Q": "<u8"}
+
+#NumPy sample types for (compressioncode, bitspersample) of PCM data
+pcmdtypes = {(1, 8): "u1", (1, 16): "<i2", (1, 32): "<i4",
+	     (3, 32): "<f4", (3, 64): "<f8"}
+
+#Loudness analysis settings. The K-weighting stages are the BS.1770
+#shelf and high pass filters as (f0, Q, gain dB, shelf exponent), turned
+#into FIR filters of kweightingseconds so blocks can be filtered by FFT
+kweightingstages = ((1681.974450955533, 0.7071752369554196,
+		     3.999843853973347, 0.4996667741545416),
+		    (38.13547087602444, 0.5003270373238773, None, None))
+kweightingseconds = 0.25
+truepeakfactor = 4
+truepeaktaps = 12
+#Value of an unknown bext loudness field
+bextunknownloudness = 0x7FFF
+#Waveform peak files: a header, the number of peaks in each level, then
+#the levels as int16 (min, max) pairs per channel. Level 0 has a peak for
+#every peakbasesamples frames and each level above halves that
+peakbasesamples = 256
+#Waveform columns are taken from a level with at least this many peaks in
+#each, so a column's edges are off by a fraction of a column at most
+peakcolumnpeaks = 8
+peakfileextension = ".pk"
+peakfilemagic = "CDPK"
+peakfileversion = 1
+peakfilestruct = Struct("<4sHHQdIQIH")
+
+#MPEG audio tables, indexed by the bit fields of the frame header
+mpegversions = (2.5, "reserved", 2, 1)
+mpeglayers = ("reserved", 3, 2, 1)
+mpegbitrates = {
+    (1, 1): ('free', 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352,
+	     384, 416, 448),
+    (1, 2): ('free', 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256,
+	     320, 384),
+    (1, 3): ('free', 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224,
+	     256, 320),
+    (2, 1): ('free', 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192,
+	     224, 256),
+    (2, 2): ('free', 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144,
+	     160),
+    (2, 3): ('free', 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144,
+	     160)}
+mpegsamplerates = {1: (44100, 48000, 32000), 2: (22050, 24000, 16000),
+		   2.5: (11025, 12000, 8000)}
+#Header bits that decide the length of a frame: sync, version, layer,
+#bitrate, sample rate and padding
+mpegframemask = 0xFFFEFE00
+mpegframecache = dict()
+mpegchannels = (2, 2, 2, 1)
+mpegfmtlayers = ("null", 1, 2, 4)
+mpegfmtmodes = (1, 2, 4, 8)
+mpegfmtmodeexts = (1, 2, 4, 8)
+#Decoded MpegInfoDescriptor fields for each header word seen so far
+mpegheadercache = dict()
+#MPEG Layer II allocation bits per subband in the ISO 11172-3 tables A to D
+#and the ISO 13818-3 low sample rate table, and the number of scalefactors
+#for each scfsi value
+mpeglayer2allocbits = {"A": (4,) * 11 + (3,) * 12 + (2,) * 4,
+		       "B": (4,) * 11 + (3,) * 12 + (2,) * 7,
+		       "C": (4,) * 2 + (3,) * 6,
+		       "D": (4,) * 2 + (3,) * 10,
+		       "LSF": (4,) * 4 + (3,) * 7 + (2,) * 19}
+mpeglayer2scalefactors = (3, 2, 1, 2)
+#MpegLayer2Layout results for each masked header word seen so far
+mpeglayer2layouts = dict()
+#Header bits that change the layout of a Layer II frame
+mpeglayer2layoutmask = 0xFFFFFCF0
+
+#Post timer detection settings: audio below silencethreshold dBFS for
+#silencegap seconds separates segments, measured in blocks of
+#levelblockseconds for PCM and in frames for MPEG
+silencethreshold = -50.0
+silencegap = 1.0
+levelblockseconds = 0.01
+
 class InvalidMPEGDataError(Exception):
     """A custom exception to indicate any problems decoding MPEG data fields in the header or possibly conflicting settings"""
     def __init__(self, value):
@@ -42,9 +145,107 @@ class InvalidMPEGDataError(Exception):
     def __str__(self):
 	return repr(self.value)
 
+class InvalidCartDataError(Exception):
+    """A custom exception to indicate cart XML or a cart sidecar record
+    that cannot be read"""
+    def __init__(self, value):
+	self.value = value
+    def __str__(self):
+	return repr(self.value)
+
+class InvalidCartFieldError(ValueError):
+    """A custom exception listing every invalid value given to
+    CartChunk.update"""
+    def __init__(self, errors):
+	ValueError.__init__(self, errors)
+	self.errors = errors
+    def __str__(self):
+	return "; ".join(self.errors)
+
+class ChunkSchema:
+    """Class describing the layout of a chunk as (name, struct format code)
+    pairs for its fixed size fields, in order, and optionally the name of
+    a variable length field taking the rest of the chunk. The Struct for
+    the fixed part is compiled once, when the chunk class is defined.
+    stripnuls says whether string fields are decoded without their NUL
+    padding, and absent gives the values of fields a shorter variant of a
+    chunk does not have"""
+    def __init__(self, fields, tail=None, stripnuls=False, absent=None):
+	self.fields = tuple(fields)
+	self.names = tuple(name for name, code in self.fields)
+	self.tail = tail
+	self.stripnuls = stripnuls
+	self.absent = absent or dict()
+	self.dtype = None
+	self.format = "<" + "".join(code for name, code in self.fields)
+	self.struct = Struct(self.format)
+	self.size = self.struct.size
+	self.getter = attrgetter(*self.names)
+	self.indexes = dict((name, i) for i, name in enumerate(self.names))
+	self.offsets = dict()
+	self.fieldstructs = dict()
+	offset = 0
+	for name, code in self.fields:
+	    self.offsets[name] = offset
+	    self.fieldstructs[name] = Struct("<" + code)
+	    offset += self.fieldstructs[name].size
+
+    def Dtype(self):
+	"""Return a NumPy structured dtype laid out like the fixed part"""
+	if numpy is None:
+	    raise ImportError("NumPy is needed for structured dtypes")
+	if self.dtype is None:
+	    self.dtype = numpy.dtype([(name, "S" + code[:-1]
+				       if code.endswith("s")
+				       else structdtypes[code])
+				      for name, code in self.fields])
+	return self.dtype
+
+    def Field(self, data, name):
+	"""Return the undecoded value of one field of data"""
+	if name == self.tail:
+	    return data[self.size:]
+	return self.fieldstructs[name].unpack_from(data, self.offsets[name])[0]
+
+    def Unpack(self, data):
+	"""Return (name, value) pairs for the fixed fields of data, followed
+	by the tail field and the rest of data if there is one"""
+	values = zip(self.names, self.struct.unpack_from(data))
+	if self.tail is not None:
+	    values.append((self.tail, data[self.size:]))
+	return values
+
+    def Pack(self, obj, tail="", **overrides):
+	"""Pack the fixed fields of obj, or the values given for some of
+	them, followed by tail"""
+	values = self.getter(obj)
+	if len(self.names) == 1:
+	    values = (values,)
+	if overrides:
+	    values = list(values)
+	    for name, value in overrides.iteritems():
+		values[self.indexes[name]] = value
+	return self.struct.pack(*values) + tail
+
 class CartChunk:
     """A Class representing the fields in a CartChunk chunk"""
-    formatstring = "<4s64s64s64s64s64s64s64s10s8s10s8s64s64s64sL64s276s1024s{0}s"
+    schema = ChunkSchema((("version", "4s"), ("title", "64s"),
+	("artist", "64s"), ("cutnum", "64s"), ("clientid", "64s"),
+	("category", "64s"), ("classification", "64s"), ("outcue", "64s"),
+	("startdate", "10s"), ("starttime", "8s"), ("enddate", "10s"),
+	("endtime", "8s"), ("appid", "64s"), ("appver", "64s"),
+	("userdef", "64s"), ("zerodbref", "L"), ("posttimers", "64s"),
+	("reserved", "276s"), ("url", "1024s")), tail="tagtext",
+	stripnuls=True)
+    formatstring = schema.format + "{0}s"
+    #The eight (postcode, sample value) post timers
+    posttimerstruct = Struct("<" + "4sL" * 8)
+    #Fields that must match a pattern: (pattern, kind, format to show)
+    fieldformats = dict.fromkeys(("startdate", "enddate"), (re.compile(
+	r'[1-9][0-9][0-9][0-9]/(0[1-9]|1[0-2])/(0[1-9]|[12][0-9]|3[01])$'),
+	"date", "YYYY/MM/DD"))
+    fieldformats.update(dict.fromkeys(("starttime", "endtime"), (re.compile(
+	r'([01][0-9]|2[0-3]):[0-5][0-9]:[0-5][0-9]$'), "time", "HH:MM:SS")))
     #formatstring = "<4s64s64s64s64s64s64s64s10s8s10s8s64s64s64sH340s716s{0}s"
     #formatstring = "<4s64s64s64s64s64s64s64s10s8s10s8s64s64s64sH32s1024s{0}s"
     def __init__(self):
@@ -87,24 +288,50 @@ class CartChunk:
 	     ' questions."/></program-associated-data>'
 
     def __setattr__(self, attrname, value):
-	if attrname == "enddate" or attrname == "startdate":
-	    if re.match( r'[1-9][0-9][0-9][0-9]/[0-1][0-9]/[0-3][0-9]', value):
-		self.__dict__[attrname] = value
-	    else:
-		self.__dict__[attrname] = value
-		raise ValueError("Invalid date format provided for attribute"
-			         " '{0}'. Should be YYYY/MM/DD".format(attrname))
-	if attrname == "endtime" or attrname == "starttime":
-	    if re.match( r'([0-2][0-3])|([0-1][0-9]):[0-5][0-9]:[0-5][0-9]', value):
-		self.__dict__[attrname] = value
-	    else:
-		self.__dict__[attrname] = value
-		raise ValueError("Invalid time format provided for attribute"
-			         " '{0}'. Should be HH:MM:SS".format(attrname))
-	if attrname == "zerodbref":
-	    self.__dict__[attrname] = int(value)
-	else:
-	    self.__dict__[attrname] = value
+	self.__dict__[attrname] = self.CheckField(attrname, value)
+
+    def CheckField(self, attrname, value):
+	"""Return value as it is stored in field attrname, or raise
+	ValueError if it is not valid for the field"""
+	if attrname in self.fieldformats:
+	    pattern, kind, example = self.fieldformats[attrname]
+	    if (not isinstance(value, basestring) or
+		    pattern.match(value) is None):
+		raise ValueError("Invalid {0} format provided for attribute"
+				 " '{1}'. Should be {2}".format(kind, attrname,
+				 example))
+	elif attrname == "zerodbref":
+	    try:
+		return int(value)
+	    except (ValueError, TypeError):
+		raise ValueError("Invalid number provided for attribute"
+				 " '{0}'".format(attrname))
+	return value
+
+    def update(self, **fields):
+	"""Set several fields at once. Every value is checked first; if
+	any is invalid none of them are set, and InvalidCartFieldError
+	lists all the problems"""
+	values = dict()
+	errors = []
+	for field, value in fields.iteritems():
+	    if field not in self.schema.indexes and field != self.schema.tail:
+		errors.append((field, "Unknown CartChunk field '{0}'".format(
+			       field)))
+		continue
+	    try:
+		values[field] = self.CheckField(field, value)
+	    except ValueError as inst:
+		errors.append((field, str(inst)))
+	if errors:
+	    raise InvalidCartFieldError([error for field, error in
+					 sorted(errors)])
+	self.__dict__.update(values)
+
+    def SetDecodedFields(self, fields):
+	"""Set fields decoded from a file without checking them. Whatever
+	a file holds is kept, even values update would refuse"""
+	self.__dict__.update(fields)
 
     def __str__(self):
 	if len(self.url) > 100:
@@ -141,107 +368,112 @@ TagText: {19!r}
 		url, tagtext)
 
     def DecodeBinString(self, header, chunksize):
-        #print self.formatstring
-	#print chunksize
-	data = zip( ("version", "title", "artist", "cutnum", "clientid", 
-	    "category", "classification", "outcue", "startdate", "starttime",
-	    "enddate", "endtime", "appid", "appver", "userdef", "zerodbref",
-	    "posttimers","reserved", "url", "tagtext"), unpack(
-		self.formatstring.format(len(header) - 2048), header))
-	for objfield, value in data:
-	    try:
-		if objfield == "posttimers":
-		    timerlist = []
-		    for i in range(8):
-			(postcode, sampleval) = unpack("<4sL", 
-				value[i*8:(i*8)+8])
-			timerlist.append((postcode, sampleval))
-		    setattr(self, objfield, timerlist)
-		else:
-		    setattr(self, objfield, str(value).strip("\x00"))
-	    except ValueError:
-		pass
-	    except Exception as inst:
-		raise inst
+	fields = dict()
+	for objfield, value in self.schema.Unpack(header):
+	    if objfield == "posttimers":
+		timers = self.posttimerstruct.unpack(value)
+		value = zip(timers[0::2], timers[1::2])
+	    elif isinstance(value, str):
+		value = value.strip("\x00")
+	    fields[objfield] = value
+	self.SetDecodedFields(fields)
 	
     def EncodeBinString(self):
-	posttimerstring = ""
-	for (postcode, sampleval) in self.posttimers:
-	    posttimerstring = posttimerstring + pack(
-		                  "<4sL", postcode, sampleval)
-	if len(posttimerstring) < 64:
-	    posttimerstring = posttimerstring + "\x00" * (64 - len(
-		posttimerstring))
-	chunklen = 646	
-	if len(self.tagtext) < chunklen:
-	    tagtext = "\x00" * (646 - len(self.tagtext)) + self.tagtext
-	else:
-	    tagtext = self.tagtext
-	    chunklen = len(self.tagtext)
-	return pack(self.formatstring.format(len(self.tagtext)), self.version, 
-		self.title, self.artist, self.cutnum, self.clientid, 
-		self.category, self.classification, self.outcue, 
-		self.startdate, self.starttime, self.enddate, self.endtime,
-		self.appid, self.appver, self.userdef, self.zerodbref, 
-		posttimerstring, self.reserved, self.url, self.tagtext)
+	#Missing timers are left as NULs, extra ones do not fit
+	timers = [value for timer in self.posttimers[:8] for value in timer]
+	timers.extend(("", 0) * (8 - len(timers) // 2))
+	return self.schema.Pack(self, self.tagtext,
+		posttimers=self.posttimerstruct.pack(*timers))
 
-    def ExportXMLValues(self):
-	impl = getDOMImplementation()
-	data = impl.createDocument(None, "cart", None)
-	top_element = data.documentElement
-	timerlist = []
-	for postcode, sampleval in self.posttimers:
-	    node = data.createElement("timer")
-	    node.setAttributeNode(data.createAttribute("type"))
-	    node.setAttribute("type", str(postcode).strip("\x00"))
-	    node.appendChild(data.createTextNode(str(sampleval)))
-	    timerlist.append(node)
+    def ExportXMLElement(self):
+	"""Return the xmlfields as an ElementTree cart element"""
+	cart = ElementTree.Element("cart")
 	for field in self.xmlfields:
-	    node = data.createElement(field)
+	    node = ElementTree.SubElement(cart, field)
 	    if field == "posttimers":
-		for timer in timerlist:
-		    node.appendChild(timer)
+		for postcode, sampleval in self.posttimers:
+		    timer = ElementTree.SubElement(node, "timer",
+			    type=XMLText(str(postcode).strip("\x00")))
+		    timer.text = str(sampleval)
 	    else:
-		node.appendChild(data.createTextNode(
-		    str(getattr(self, field)) ))
-	    top_element.appendChild(node)
-	xmlstring = data.toxml()
-	data.unlink()
+		node.text = XMLText(str(getattr(self, field)))
+	return cart
 
-	return xmlstring 
+    def ExportXMLValues(self):
+	return '<?xml version="1.0" ?>' + ElementTree.tostring(
+		self.ExportXMLElement())
+
+    def ImportXMLElement(self, cart):
+	"""Set the xmlfields from an ElementTree cart element, all at once"""
+	fields = dict()
+	for field in self.xmlfields:
+	    node = cart.find(field)
+	    if node is None:
+		raise InvalidCartDataError("missing <{0}> in cart XML".format(
+					   field))
+	    if field == "posttimers":
+		try:
+		    fields[field] = [(timer.get("type", "").encode("latin-1"),
+				      int(timer.text))
+				     for timer in node.findall("timer")]
+		except (TypeError, ValueError):
+		    raise InvalidCartDataError("invalid post timer in cart"
+					       " XML")
+	    else:
+		fields[field] = (node.text or "").encode("latin-1")
+	self.update(**fields)
 
     def ImportXMLValues(self, xmlstring):
-	#print xmlstring
 	try:
-	    data = parseString(xmlstring)
+	    cart = ElementTree.fromstring(xmlstring)
+	except SyntaxError as inst:
+	    raise InvalidCartDataError("invalid cart XML: {0}".format(inst))
+	if cart.tag != "cart":
+	    cart = cart.find("cart")
+	    if cart is None:
+		raise InvalidCartDataError("no <cart> in cart XML")
+	self.ImportXMLElement(cart)
+
+    def ExportDictValues(self):
+	"""Return the xmlfields as a dict, post timers as [type, value]"""
+	values = dict((field, getattr(self, field)) for field in self.xmlfields)
+	values["posttimers"] = [[str(postcode).strip("\x00"), sampleval]
+				for postcode, sampleval in self.posttimers]
+	return values
+
+    def ImportDictValues(self, values):
+	"""Set the xmlfields from a dict like ExportDictValues returns, all
+	at once"""
+	fields = dict()
+	try:
 	    for field in self.xmlfields:
+		value = values[field]
 		if field == "posttimers":
-		    node = data.getElementsByTagName(field)[0]
-		    timerlist = []
-		    for posttimer in node.childNodes:
-			timerlist.append((str(posttimer.getAttribute("type")),
-			    int(posttimer.firstChild.data)))
-		    setattr(self, field, timerlist)
-		else:
-		    node = data.getElementsByTagName(field)[0].firstChild
-		    if node is not None:
-		   	 #print field, node.data
-		        setattr(self, field, str(node.data))
-		    else:
-		        #print field
-		        setattr(self, field, "")
-	except ValueError as inst:
-	    raise inst
-	except IndexError as inst:
-	    print "missing tags in xml - import failed:", field
-	except Exception as inst:
-	    print "invalid xml - import failed:", inst, field
-	finally:
-	    data.unlink()
+		    value = [(str(postcode), int(sampleval))
+			     for postcode, sampleval in value]
+		elif isinstance(value, unicode):
+		    value = value.encode("latin-1")
+		fields[field] = value
+	except KeyError as inst:
+	    raise InvalidCartDataError("missing {0} in cart record".format(
+				       inst))
+	except (TypeError, ValueError):
+	    raise InvalidCartDataError("invalid post timer in cart record")
+	self.update(**fields)
 
 class BextChunk:
     """Class that represents the fields in a EBU defined Bext Chunk"""
-    formatstring = "<256s32s32s10s8sLLH64s190s{0}s"
+    schema = ChunkSchema((("title", "256s"), ("author", "32s"),
+	("reference", "32s"), ("origindate", "10s"), ("origintime", "8s"),
+	("timereflow", "L"), ("timerefhigh", "L"), ("version", "H"),
+	("umid", "64s"), ("loudnessvalue", "h"), ("loudnessrange", "h"),
+	("maxtruepeaklevel", "h"), ("maxmomentaryloudness", "h"),
+	("maxshorttermloudness", "h"), ("reserved", "180s")),
+	tail="codinghistory", stripnuls=True)
+    #Version 2 loudness fields, stored in hundredths of a LUFS, LU or dBTP
+    loudnessfields = ("loudnessvalue", "loudnessrange", "maxtruepeaklevel",
+		      "maxmomentaryloudness", "maxshorttermloudness")
+    formatstring = schema.format + "{0}s"
     def __init__(self):
         self.title = ""
         self.author = ""
@@ -252,6 +484,8 @@ class BextChunk:
         self.timerefhigh = 0
         self.version = 1
         self.umid = "\x00" * 64
+	for field in self.loudnessfields:
+	    setattr(self, field, 0)
         self.reserved = ""
         self.codinghistory = "A=MPEG1L2,F=44100,B=256,M=STEREO,T=CV_PcxTl2NP\x0d\x0a"
 
@@ -265,44 +499,62 @@ Time Reference Low: {5}
 Time Reference High: {6}
 Version: {7}
 SMTPE UMID: {8}
+Loudness Value: {11}
+Loudness Range: {12}
+Max True Peak Level: {13}
+Max Momentary Loudness: {14}
+Max Short Term Loudness: {15}
 Reserved: {9}
 Coding History: {10!r}
 """.format( self.title, self.author, self.reference, self.origindate,
 	    self.origintime, self.timereflow, self.timerefhigh, self.version,
-	    "[unsupported]", self.reserved, self.codinghistory )
+	    "[unsupported]", self.reserved, self.codinghistory,
+	    *[self.LoudnessText(field) for field in self.loudnessfields] )
 
     def __setattr__(self, attrname, value):
 	if (attrname == "timereflow" or
 	    attrname == "timerefhigh" or
-	    attrname == "version" ):
+	    attrname == "version" or
+	    attrname in self.loudnessfields ):
 	    self.__dict__[attrname] = int(value)
 	else:
 	    self.__dict__[attrname] = value
 
+    def LoudnessText(self, field):
+	value = getattr(self, field)
+	if self.version < 2:
+	    return "[not present]"
+	if value == bextunknownloudness:
+	    return "[unknown]"
+	return "{0:.2f}".format(value / 100.0)
+
+    def SetLoudness(self, field, value):
+	"""Store a level in dB or LU in a loudness field, in hundredths"""
+	if value is None or value != value or abs(value) == float("inf"):
+	    setattr(self, field, bextunknownloudness)
+	else:
+	    setattr(self, field, max(-32768, min(32766,
+		int(round(value * 100)))))
+
     def DecodeBinString(self, header, chunksize):
-	data = zip(("title", "author", "reference", "origindate", "origintime",
-	    "timereflow", "timerefhigh", "version", "umid", "reserved", 
-	    "codinghistory"), 
-	    unpack(self.formatstring.format(len(header) - 602 ), header))
-	for objfield, value in data:
-	    try:
-		setattr(self, objfield, str(value).strip("\x00"))
-	    except Exception as inst:
-		raise inst
+	for objfield, value in self.schema.Unpack(header):
+	    if isinstance(value, str):
+		value = value.strip("\x00")
+	    setattr(self, objfield, value)
 
     def EncodeBinString(self):
+	#NUL terminate the coding history and keep the chunk even sized
 	cdglength = len(self.codinghistory + "\x00\x00")
 	if (cdglength % 2) == 1:
 	    cdglength -= 1
-	return pack(self.formatstring.format(cdglength),
-		self.title, self.author, self.reference, self.origindate,
-		self.origintime, self.timereflow, self.timerefhigh, 
-		self.version, self.umid, self.reserved, 
-		self.codinghistory)
+	return self.schema.Pack(self, self.codinghistory + "\x00" * (
+		cdglength - len(self.codinghistory)))
 
 class MextChunk:
     """Class that represents the fields in a mpeg extension (mext) chunk"""
-    formatstring = "<2sHHH4s"
+    schema = ChunkSchema((("soundinfo", "2s"), ("framesize", "H"),
+	("ancildataln", "H"), ("ancildatadef", "H"), ("reserved", "4s")))
+    formatstring = schema.format
     def __init__(self):
 	self.soundinfo = "\x07\x00"
 	self.framesize = 0
@@ -331,16 +583,15 @@ Ancillary Data Definition: {4}
 	self.framesize = mpeginfo.framesize
 
     def DecodeBinString(self, header, chunksize):
-	(self.soundinfo, self.framesize, self.ancildataln, self.ancildatadef, 
-		self.reserved) = unpack(self.formatstring, header)
+	self.__dict__.update(self.schema.Unpack(header))
 
     def EncodeBinString(self):
-	return pack(self.formatstring, self.soundinfo, self.framesize, 
-		self.ancildataln, self.ancildatadef, self.reserved)
+	return self.schema.Pack(self)
 
 class FactChunk:
     """Class that represents the information contained in a Fact Chunk"""
-    formatstring = "<L"
+    schema = ChunkSchema((("numsamples", "L"),))
+    formatstring = schema.format
     def __init__(self):
 	self.numsamples = 0
 
@@ -351,14 +602,28 @@ class FactChunk:
 	self.numsamples = mpegheader.numsamples
 
     def DecodeBinString(self, header, chunksize):
-	self.numsamples, = unpack(self.formatstring, header)
+	self.numsamples, = self.schema.struct.unpack_from(header)
 
     def EncodeBinString(self):
-	return pack(self.formatstring, self.numsamples)
+	return self.schema.Pack(self)
 
 class FmtChunk:
     """Class that represents the information in a Fmt Chunk"""
-    formatstring = "<HHLLHHHHLHHHHLL"
+    #PCM (16), WAVEFORMATEX (18) and MPEG1WAVEFORMAT (40) layouts, by size
+    schemas = dict()
+    mpegfields = (("headlayer", "H"), ("headbitrate", "L"), ("headmode", "H"),
+	("headmodeext", "H"), ("heademphasis", "H"), ("headflags", "H"),
+	("ptslow", "L"), ("ptshigh", "L"))
+    schemas[16] = ChunkSchema((("compressioncode", "H"),
+	("numchannels", "H"), ("samplerate", "L"), ("byterate", "L"),
+	("blockalign", "H"), ("bitspersample", "H")),
+	absent=dict.fromkeys(("subchunksize",) +
+			     tuple(name for name, code in mpegfields), 0))
+    schemas[18] = ChunkSchema(schemas[16].fields + (("subchunksize", "H"),),
+	absent=dict.fromkeys((name for name, code in mpegfields), 0))
+    schemas[40] = ChunkSchema(schemas[18].fields + mpegfields)
+    schema = schemas[40]
+    formatstring = schema.format
     def __init__(self):
 	self.compressioncode = 80
 	self.numchannels = 0
@@ -430,78 +695,560 @@ Sub-chunk size: {6}
 	self.__dict__[attrname] = value
 
     def DecodeBinString(self, header, chunksize):
-	if chunksize == 40:
-	    (self.compressioncode, self.numchannels, self.samplerate, self.byterate,
-	     self.blockalign, self.bitspersample, self.subchunksize, self.headlayer,
-	     self.headbitrate, self.headmode, self.headmodeext, self.heademphasis,
-	     self.headflags, self.ptslow,
-	     self.ptshigh) = unpack(self.formatstring, header)
-	elif chunksize == 18:
-            (self.compressioncode, self.numchannels, self.samplerate, self.byterate,
-	     self.blockalign, self.bitspersample, self.subchunksize) = unpack(
-	         "<HHIIHHH", header)
-	elif chunksize == 16:
-            (self.compressioncode, self.numchannels, self.samplerate, self.byterate,
-	     self.blockalign, self.bitspersample) = unpack("<HHIIHH", header)
-	    self.subchunksize = 0
-	else:
+	if chunksize not in self.schemas:
 	    raise Exception("Could not decode FMT chunk")
+	if chunksize == 16:
+	    self.subchunksize = 0
+	self.__dict__.update(self.schemas[chunksize].Unpack(header))
 
     def EncodeBinString(self):
 	if self.compressioncode == 1:
-	    return pack("<HHIIHHH", self.compressioncode, self.numchannels,
-		self.samplerate, self.byterate, self.blockalign, 
-		self.bitspersample, self.subchunksize)
-
-	return pack(self.formatstring, self.compressioncode, self.numchannels,
-		self.samplerate, self.byterate, self.blockalign, 
-		self.bitspersample, self.subchunksize, self.headlayer,
-		self.headbitrate, self.headmode, self.headmodeext, 
-		self.heademphasis, self.headflags, self.ptslow, self.ptshigh) 
+	    schema = self.schemas[18]
+	else:
+	    schema = self.schemas[40]
+	return schema.Pack(self)
 
 class MpegInfoDescriptor:
     """Class that represents the information contained in an MPEG header"""
     def __init__(self, mpegheader, filesize):
-	mpegheader, = unpack(">L", mpegheader)
-	headerbin = "{0:b}".format(mpegheader)
-	#If headerbin[0:11] is not all ones, it is not a valid header
-	
-	MpegVerTable = (2.5, "reserved", 2, 1)
-	MpegLyrTable = ("reserved", 3, 2, 1)
-	FmtLyrTable = ("null", 1, 2, 4)
-	FmtModeTable = (1, 2, 4, 8)
-	FmtModeExtTable = (1, 2, 4, 8)
-	Mpeg1L2BRTable = ('free', 32, 48, 56, 64, 80, 96, 112, 128, 160,
-		          192, 224, 256, 320, 384 )
-	Mpeg1L3BRTable = ('free', 32, 40, 48, 56, 64, 80, 96, 112, 128,
-		          160, 192, 224, 256, 320 )
-	Mpeg1SRTable = (44100, 48000, 32000, "reserved")
-	MpegChanModeTable = (2, 2, 2, 1)
-
-	self.mpegver = MpegVerTable[int(headerbin[11:13], 2)]
-	self.mpeglyr = MpegLyrTable[int(headerbin[13:15], 2)]
-	self.protectbit = headerbin[15]
-	self.bitrate = Mpeg1L2BRTable[int(headerbin[16:20], 2)]
-	self.samplerate = Mpeg1SRTable[int(headerbin[20:22], 2)]
-	self.padding = headerbin[22]
-	self.privatebit = headerbin[23]
-	self.numchannels = MpegChanModeTable[int(headerbin[24:26], 2)]
-	self.channelmode = int(headerbin[24:26], 2)
-	self.modeext = int(headerbin[26:28], 2)
-	self.copyrightbit = headerbin[28]
-	self.originalbit = headerbin[29]
-	self.emphasis = int(headerbin[30:32], 2)
-	self.framesize = int( (144 * self.bitrate * 1000 / self.samplerate)
-		              + int(self.padding) )
+	if isinstance(mpegheader, str):
+	    mpegheader, = unpack(">L", mpegheader)
+	try:
+	    fields = mpegheadercache[mpegheader]
+	except KeyError:
+	    fields = DecodeMpegHeader(mpegheader)
+	self.__dict__.update(fields)
 	self.datasize = filesize
-	self.numsamples = int( self.datasize / self.framesize * 1152 )
-	self.fmtlayer = FmtLyrTable[self.mpeglyr]
-	self.fmtmode = FmtModeTable[self.channelmode]
-	self.fmtmodeext = FmtModeExtTable[self.modeext]
-	self.fmtemphasis = self.emphasis + 1
-	self.fmtheadflags = int("0001" + self.protectbit + self.originalbit
-		                 + self.copyrightbit + self.privatebit, 2 )
-	self.mpegheader = mpegheader
+	self.numsamples = int( self.datasize / self.framesize *
+			       self.samplesperframe )
+	
+def DecodeMpegHeader(mpegheader):
+    """Decode the fields of a 32 bit MPEG audio header word into a dict of
+    MpegInfoDescriptor attributes and remember them in mpegheadercache"""
+    frameinfo = MpegFrameLength(mpegheader)
+    if frameinfo is None:
+	raise InvalidMPEGDataError("Unsupported or invalid MPEG header "
+				   "{0:#010x}".format(mpegheader))
+    fields = dict()
+    fields["mpegver"] = mpegversions[(mpegheader >> 19) & 3]
+    fields["mpeglyr"] = mpeglayers[(mpegheader >> 17) & 3]
+    fields["protectbit"] = str((mpegheader >> 16) & 1)
+    fields["bitrate"] = mpegbitrates[(int(fields["mpegver"]),
+				      fields["mpeglyr"])][
+				      (mpegheader >> 12) & 15]
+    fields["samplerate"] = frameinfo[2]
+    fields["padding"] = str((mpegheader >> 9) & 1)
+    fields["privatebit"] = str((mpegheader >> 8) & 1)
+    fields["channelmode"] = (mpegheader >> 6) & 3
+    fields["numchannels"] = mpegchannels[fields["channelmode"]]
+    fields["modeext"] = (mpegheader >> 4) & 3
+    fields["copyrightbit"] = str((mpegheader >> 3) & 1)
+    fields["originalbit"] = str((mpegheader >> 2) & 1)
+    fields["emphasis"] = mpegheader & 3
+    fields["framesize"] = frameinfo[0]
+    fields["samplesperframe"] = frameinfo[1]
+    fields["fmtlayer"] = mpegfmtlayers[fields["mpeglyr"]]
+    fields["fmtmode"] = mpegfmtmodes[fields["channelmode"]]
+    fields["fmtmodeext"] = mpegfmtmodeexts[fields["modeext"]]
+    fields["fmtemphasis"] = fields["emphasis"] + 1
+    fields["fmtheadflags"] = (0x10 | ((mpegheader >> 13) & 8) |
+			      (mpegheader & 4) |
+			      ((mpegheader >> 2) & 2) |
+			      ((mpegheader >> 8) & 1))
+    fields["mpegheader"] = mpegheader
+    mpegheadercache[mpegheader] = fields
+    return fields
+
+def MpegFrameLength(headerword):
+    """Return (framelength, samplesperframe, samplerate) for a 32 bit MPEG
+    audio header word, or None if the word is not a usable frame header"""
+    key = headerword & mpegframemask
+    try:
+	return mpegframecache[key]
+    except KeyError:
+	pass
+    version = mpegversions[(key >> 19) & 3]
+    layer = mpeglayers[(key >> 17) & 3]
+    bitrateindex = (key >> 12) & 15
+    samplerateindex = (key >> 10) & 3
+    padding = (key >> 9) & 1
+    if ((key & 0xFFE00000) != 0xFFE00000 or version == "reserved" or
+	    layer == "reserved" or bitrateindex in (0, 15) or
+	    samplerateindex == 3):
+	#Free format frames have no length in the header
+	frameinfo = None
+    else:
+	bitrate = mpegbitrates[(int(version), layer)][bitrateindex] * 1000
+	samplerate = mpegsamplerates[version][samplerateindex]
+	if layer == 1:
+	    frameinfo = ((12 * bitrate // samplerate + padding) * 4, 384,
+			 samplerate)
+	elif layer == 3 and version != 1:
+	    frameinfo = (72 * bitrate // samplerate + padding, 576, samplerate)
+	else:
+	    frameinfo = (144 * bitrate // samplerate + padding, 1152,
+			 samplerate)
+    mpegframecache[key] = frameinfo
+    return frameinfo
+
+class MpegFrameIndex:
+    """Class holding the offset of every frame in a block of MPEG audio"""
+    def __init__(self):
+	self.offsets = array("I")
+	self.samplesperframe = 1152
+	self.samplerate = 0
+	self.paddedframes = 0
+	self.bitrates = set()
+	self.samplerates = set()
+	self.freeformat = False
+	self.junkbytes = 0
+	self.datasize = 0
+
+    def __str__(self):
+	return """Number of Frames: {0}
+Number of Samples: {1}
+Duration: {2:.3f}
+Padded Frames: {3}
+Bitrates (kbps): {4}
+Junk Bytes: {5}
+""".format(len(self.offsets), self.NumSamples(), self.Duration(),
+	   self.paddedframes, sorted(self.bitrates), self.junkbytes)
+
+    def NumSamples(self):
+	return len(self.offsets) * self.samplesperframe
+
+    def Duration(self):
+	if self.samplerate == 0:
+	    return 0.0
+	return float(self.NumSamples()) / self.samplerate
+
+    def TimeToFrame(self, seconds):
+	frame = int(seconds * self.samplerate) // self.samplesperframe
+	return max(0, min(frame, len(self.offsets)))
+
+    def NearestFrame(self, seconds):
+	"""Return the number of the frame starting nearest the given time,
+	which is the frame count if that is the end of the audio"""
+	frame = int(round(float(seconds) * self.samplerate /
+			  self.samplesperframe))
+	return max(0, min(frame, len(self.offsets)))
+
+    def TimeToOffset(self, seconds):
+	"""Return the offset of the frame playing at the given time, or the
+	end of the audio if the time is past the last frame"""
+	frame = self.TimeToFrame(seconds)
+	if frame == len(self.offsets):
+	    return self.datasize
+	return self.offsets[frame]
+
+    def Extend(self, other, shift):
+	"""Add the frames of an index of audio that starts shift bytes after
+	the start of this one"""
+	self.offsets.extend(array("I", (offset + shift
+					for offset in other.offsets)))
+	if other.samplerate:
+	    self.samplesperframe = other.samplesperframe
+	    self.samplerate = other.samplerate
+	self.paddedframes += other.paddedframes
+	self.bitrates |= other.bitrates
+	self.samplerates |= other.samplerates
+	self.freeformat = self.freeformat or other.freeformat
+	self.junkbytes += other.junkbytes
+	if other.offsets:
+	    self.datasize = shift + other.datasize
+
+    def SoundInfo(self):
+	"""Return the mext chunk SoundInfo flags for the indexed frames"""
+	soundinfo = 0
+	if (len(self.bitrates) == 1 and len(self.samplerates) == 1 and
+		self.junkbytes == 0):
+	    soundinfo |= 1
+	if self.paddedframes == 0:
+	    soundinfo |= 2
+	    if self.samplerate in (22050, 44100):
+		soundinfo |= 4
+	if self.freeformat:
+	    soundinfo |= 8
+	return pack("<H", soundinfo)
+
+def KWeightingTaps(samplerate):
+    """Return the impulse response of the BS.1770 K-weighting filter at
+    samplerate, cut to kweightingseconds. The filter is built from the
+    analog prototypes so it works at any sample rate"""
+    taps = 1 << int(kweightingseconds * samplerate - 1).bit_length()
+    z = numpy.exp(-1j * numpy.linspace(0, numpy.pi, 4 * taps + 1))
+    response = numpy.ones(len(z), complex)
+    for f0, q, gain, shelf in kweightingstages:
+	k = numpy.tan(numpy.pi * f0 / samplerate)
+	if gain is None:
+	    b = (1.0, -2.0, 1.0)
+	else:
+	    vh = 10 ** (gain / 20.0)
+	    vb = vh ** shelf
+	    b = (vh + vb * k / q + k * k, 2 * (k * k - vh),
+		 vh - vb * k / q + k * k)
+	a = (1 + k / q + k * k, 2 * (k * k - 1), 1 - k / q + k * k)
+	response *= ((b[0] + b[1] * z + b[2] * z * z) /
+		     (a[0] + a[1] * z + a[2] * z * z))
+    return numpy.fft.irfft(response)[:taps]
+
+def TruePeakTaps():
+    """Return the truepeakfactor phases of a windowed sinc interpolation
+    filter with truepeaktaps taps each, as an array of shape (phases,
+    taps). Phase 0 passes the original samples through"""
+    length = truepeakfactor * truepeaktaps
+    n = numpy.arange(length) - length // 2
+    taps = (numpy.sinc(n / float(truepeakfactor)) *
+	    numpy.kaiser(length + 1, 6.0)[:length])
+    return numpy.array([taps[phase::truepeakfactor]
+			for phase in range(truepeakfactor)])
+
+class FFTFilterBank:
+    """Class that runs a stream of blocks of samples through a bank of FIR
+    filters by FFT, keeping the end of each block for the next one.
+    Filters of up to directtaps taps are applied as a matrix product over
+    a sliding window of samples instead, which is faster for them"""
+    directtaps = 64
+    def __init__(self, taps, numchannels):
+	self.taps = numpy.atleast_2d(taps)
+	self.history = numpy.zeros((self.taps.shape[1] - 1, numchannels))
+	self.spectra = dict()
+
+    def Filter(self, block):
+	"""Return the block of shape (frames, channels) filtered by every
+	filter, as an array of shape (filters, frames, channels)"""
+	overlap = len(self.history)
+	extended = numpy.concatenate((self.history, block))
+	self.history = extended[len(extended) - overlap:]
+	if overlap < self.directtaps:
+	    filtered = numpy.empty((len(self.taps), len(block),
+				    block.shape[1]))
+	    for channel in range(block.shape[1]):
+		samples = numpy.ascontiguousarray(extended[:, channel])
+		windows = as_strided(samples, (len(block), overlap + 1),
+			samples.strides * 2)
+		filtered[:, :, channel] = windows.dot(
+			self.taps[:, ::-1].T).T
+	    return filtered
+	size = 1 << int(len(extended) - 1).bit_length()
+	if size not in self.spectra:
+	    self.spectra[size] = numpy.fft.rfft(self.taps, size)[:, :, None]
+	filtered = numpy.fft.irfft(numpy.fft.rfft(extended, size, axis=0) *
+		self.spectra[size], size, axis=1)[:, overlap:len(extended)]
+	return filtered
+
+class PCMDecoder:
+    """Class that turns PCM data in the format of a fmt chunk into floats"""
+    def __init__(self, fmt):
+	self.numchannels = fmt.numchannels
+	self.samplerate = fmt.samplerate
+	self.blockalign = fmt.blockalign
+	self.bitspersample = fmt.bitspersample
+	if fmt.compressioncode not in (1, 3):
+	    raise ValueError("Cannot decode audio with compression code"
+		    " {0}, only PCM".format(fmt.compressioncode))
+	if (fmt.compressioncode, fmt.bitspersample) == (1, 24):
+	    self.dtype = None
+	else:
+	    try:
+		self.dtype = numpy.dtype(pcmdtypes[(fmt.compressioncode,
+		    fmt.bitspersample)])
+	    except KeyError:
+		raise ValueError("Cannot decode {0} bit audio with"
+			" compression code {1}".format(fmt.bitspersample,
+			fmt.compressioncode))
+	if fmt.compressioncode == 1:
+	    self.fullscale = float(1 << (fmt.bitspersample - 1))
+	else:
+	    self.fullscale = 1.0
+
+    def DecodeSamples(self, data):
+	"""Return the whole frames in data as floats of shape (frames,
+	channels) scaled to full scale 1.0"""
+	if self.dtype is None:
+	    raw = numpy.frombuffer(data, numpy.uint8).reshape(-1, 3)
+	    samples = (raw[:, 0].astype(numpy.int32) |
+		       (raw[:, 1].astype(numpy.int32) << 8) |
+		       (raw[:, 2].astype(numpy.int8).astype(numpy.int32)
+			<< 16))
+	else:
+	    samples = numpy.frombuffer(data, self.dtype)
+	samples = samples.astype(numpy.float64)
+	if self.dtype is not None and self.dtype.kind == "u":
+	    samples -= self.fullscale
+	samples /= self.fullscale
+	return samples.reshape(-1, self.numchannels)
+
+    def DecodeInt16Samples(self, data):
+	"""Return the whole frames in data as samples of shape (frames,
+	channels) scaled to 16 bits. 16 bit data is used as it is; other
+	formats come back as floats ready to be cast"""
+	if self.dtype == numpy.dtype("<i2"):
+	    return numpy.frombuffer(data, self.dtype).reshape(-1,
+		    self.numchannels)
+	samples = self.DecodeSamples(data)
+	samples *= 32767.0
+	return samples.round().clip(-32768, 32767)
+
+class PCMAnalyzer(PCMDecoder):
+    """Class that measures the sample peak, true peak, RMS level and BS.1770
+    loudness of PCM audio fed to it a block at a time. Only the 100ms
+    gating block energies are kept, so memory use stays small"""
+    def __init__(self, fmt):
+	PCMDecoder.__init__(self, fmt)
+	#BS.1770 channel weights, with the LFE of 5.1 left out
+	self.weights = numpy.ones(self.numchannels)
+	if self.numchannels == 6:
+	    self.weights[3] = 0.0
+	    self.weights[4:] = 1.41
+	self.kfilter = FFTFilterBank(KWeightingTaps(self.samplerate),
+		self.numchannels)
+	self.peakfilter = FFTFilterBank(TruePeakTaps(), self.numchannels)
+	self.gatingstep = int(round(self.samplerate / 10.0))
+	self.gatingblocks = array("d")
+	self.gatingsum = 0.0
+	self.gatingframes = 0
+	self.leftover = ""
+	self.frames = 0
+	self.sumsquares = 0.0
+	self.peak = 0.0
+	self.truepeak = 0.0
+
+    def AddData(self, data):
+	"""Analyze a string of PCM data, which need not end on a frame"""
+	if self.leftover:
+	    data = self.leftover + str(data)
+	usable = len(data) - len(data) % self.blockalign
+	self.leftover = str(data[usable:])
+	if usable == 0:
+	    return
+	samples = self.DecodeSamples(buffer(data, 0, usable))
+	self.frames += len(samples)
+	self.sumsquares += float(numpy.dot(samples.ravel(), samples.ravel()))
+	self.peak = max(self.peak, float(abs(samples).max()))
+	self.truepeak = max(self.truepeak,
+		float(abs(self.peakfilter.Filter(samples)).max()))
+	weighted = self.kfilter.Filter(samples)[0]
+	energy = numpy.dot(weighted * weighted, self.weights)
+	#Fill the current 100ms gating block, then add whole blocks
+	start = min(len(energy), self.gatingstep - self.gatingframes)
+	self.gatingsum += float(energy[:start].sum())
+	self.gatingframes += start
+	if self.gatingframes < self.gatingstep:
+	    return
+	self.gatingblocks.append(self.gatingsum)
+	whole = (len(energy) - start) // self.gatingstep
+	end = start + whole * self.gatingstep
+	self.gatingblocks.extend(energy[start:end].reshape(whole,
+		self.gatingstep).sum(axis=1).tolist())
+	self.gatingsum = float(energy[end:].sum())
+	self.gatingframes = len(energy) - end
+
+    def WindowLoudness(self, steps):
+	"""Return the loudness of every window of the given number of 100ms
+	gating blocks, advancing by one block, and the window energies"""
+	blocks = numpy.frombuffer(self.gatingblocks, numpy.float64)
+	if len(blocks) < steps:
+	    return numpy.zeros(0), numpy.zeros(0)
+	sums = numpy.concatenate(([0.0], numpy.cumsum(blocks)))
+	energies = (sums[steps:] - sums[:-steps]) / (steps * self.gatingstep)
+	with numpy.errstate(divide="ignore"):
+	    return -0.691 + 10 * numpy.log10(energies), energies
+
+    def Results(self):
+	"""Return a dict of the levels of the audio analyzed so far. Levels
+	of silence or of audio too short to measure are -inf, and the
+	peak sample is in the units of the samples"""
+	def decibels(value):
+	    with numpy.errstate(divide="ignore"):
+		return float(10 * numpy.log10(value))
+	def gate(loudness, energies, relativegate):
+	    keep = loudness > -70.0
+	    if keep.any():
+		keep &= loudness > (-0.691 + relativegate +
+				    decibels(energies[keep].mean()))
+	    return loudness[keep], energies[keep]
+	momentary, energies = self.WindowLoudness(4)
+	gated, energies = gate(momentary, energies, -10.0)
+	loudness = float("-inf")
+	if len(gated):
+	    loudness = -0.691 + decibels(energies.mean())
+	shortterm, energies = self.WindowLoudness(30)
+	gated, energies = gate(shortterm, energies, -20.0)
+	loudnessrange = 0.0
+	if len(gated):
+	    low, high = numpy.percentile(gated, (10, 95))
+	    loudnessrange = float(high - low)
+	results = {"frames": self.frames, "loudness": loudness,
+		   "loudnessrange": loudnessrange,
+		   "samplepeak": 2 * decibels(self.peak),
+		   "truepeak": 2 * decibels(max(self.peak, self.truepeak)),
+		   "rms": float("-inf"),
+		   "maxmomentary": float("-inf"),
+		   "maxshortterm": float("-inf"), "peaksample": None}
+	if self.frames:
+	    results["rms"] = decibels(self.sumsquares /
+		    (self.frames * self.numchannels))
+	if len(momentary):
+	    results["maxmomentary"] = float(momentary.max())
+	if len(shortterm):
+	    results["maxshortterm"] = float(shortterm.max())
+	if self.fullscale > 1.0:
+	    results["peaksample"] = int(round(self.peak * self.fullscale))
+	return results
+
+class PeakPyramid:
+    """Class holding a min/max waveform overview of some audio at several
+    resolutions. Level n has an int16 (min, max) pair per channel for every
+    basesamples * 2 ** n frames. The levels of a pyramid read from a peak
+    file are left in the file and read a slice at a time"""
+    def __init__(self, samplerate=0, numchannels=1,
+	    basesamples=peakbasesamples):
+	self.samplerate = samplerate
+	self.numchannels = numchannels
+	self.basesamples = basesamples
+	self.numframes = 0
+	self.sourcesize = 0
+	self.sourcemtime = 0.0
+	self.counts = []
+	self.levels = []
+	self.offsets = []
+	self.peakfilename = None
+
+    def __str__(self):
+	return """Sample Rate: {0}
+Number of Channels: {1}
+Number of Frames: {2}
+Frames per Peak: {3}
+Peaks per Level: {4}
+""".format(self.samplerate, self.numchannels, self.numframes,
+	   self.basesamples, self.counts)
+
+    def SamplesPerPeak(self, level):
+	return self.basesamples << level
+
+    def SetBaseLevel(self, peaks):
+	"""Set level 0 to an array of peaks and build the levels above it
+	by combining pairs of peaks until one is left"""
+	self.levels = [peaks]
+	while len(self.levels[-1]) > 1:
+	    peaks = self.levels[-1]
+	    pairs = len(peaks) // 2
+	    upper = numpy.empty(((len(peaks) + 1) // 2, self.numchannels, 2),
+				numpy.int16)
+	    upper[:pairs, :, 0] = numpy.minimum(peaks[0:2 * pairs:2, :, 0],
+						peaks[1:2 * pairs:2, :, 0])
+	    upper[:pairs, :, 1] = numpy.maximum(peaks[0:2 * pairs:2, :, 1],
+						peaks[1:2 * pairs:2, :, 1])
+	    if len(peaks) % 2:
+		upper[-1] = peaks[-1]
+	    self.levels.append(upper)
+	self.counts = [len(peaks) for peaks in self.levels]
+
+    def Level(self, level, start=0, end=None):
+	"""Return peaks start to end of a level as an array of shape
+	(peaks, channels, 2)"""
+	if end is None or end > self.counts[level]:
+	    end = self.counts[level]
+	start = max(0, min(start, end))
+	if self.levels[level] is not None:
+	    return self.levels[level][start:end]
+	peaksize = self.numchannels * 4
+	with open(self.peakfilename, 'rb') as f:
+	    f.seek(self.offsets[level] + start * peaksize)
+	    data = f.read((end - start) * peaksize)
+	return numpy.frombuffer(data, "<i2").reshape(-1, self.numchannels, 2)
+
+    def Columns(self, width, start=0, end=None):
+	"""Return the peaks of frames start to end as at most width columns
+	of shape (columns, channels, 2). Column i covers the frames from
+	start + i * (end - start) / width on, read from the coarsest level
+	with peakcolumnpeaks peaks per column. A peak that straddles two
+	columns counts in both"""
+	if end is None or end > self.numframes:
+	    end = self.numframes
+	start = max(0, start)
+	span = end - start
+	width = min(width, span)
+	if width < 1 or not self.counts:
+	    return numpy.zeros((0, self.numchannels, 2), numpy.int16)
+	level = 0
+	while (level + 1 < len(self.counts) and self.SamplesPerPeak(level +
+		1) * width * peakcolumnpeaks <= span):
+	    level += 1
+	samplesperpeak = self.SamplesPerPeak(level)
+	first = start // samplesperpeak
+	peaks = self.Level(level, first, -(-end // samplesperpeak))
+	if len(peaks) == 0:
+	    return numpy.zeros((0, self.numchannels, 2), numpy.int16)
+	bounds = start + numpy.arange(width + 1, dtype=numpy.int64) * span \
+		// width
+	lows = numpy.minimum(bounds[:-1] // samplesperpeak - first,
+			     len(peaks) - 1)
+	#The peak each column ends in, which may start the next column
+	lasts = numpy.clip(-(-bounds[1:] // samplesperpeak) - first - 1,
+			   lows, len(peaks) - 1)
+	columns = numpy.empty((width, self.numchannels, 2), numpy.int16)
+	columns[:, :, 0] = numpy.minimum(numpy.minimum.reduceat(
+		peaks[:, :, 0], lows), peaks[lasts, :, 0])
+	columns[:, :, 1] = numpy.maximum(numpy.maximum.reduceat(
+		peaks[:, :, 1], lows), peaks[lasts, :, 1])
+	return columns
+
+    def Save(self, peakfilename):
+	"""Write the pyramid to a peak file, replacing it in one step. Each
+	writer has its own temporary file, so pyramids saved at the same
+	time never mix"""
+	header = peakfilestruct.pack(peakfilemagic, peakfileversion,
+		self.numchannels, self.sourcesize, self.sourcemtime,
+		self.samplerate, self.numframes, self.basesamples,
+		len(self.counts))
+	header += pack("<{0}Q".format(len(self.counts)), *self.counts)
+	fd, tempfilename = tempfile.mkstemp(peakfileextension + ".tmp",
+		dir=os.path.dirname(os.path.abspath(peakfilename)))
+	try:
+	    with os.fdopen(fd, 'wb') as f:
+		f.write(header)
+		for level in range(len(self.counts)):
+		    f.write(self.Level(level).astype("<i2").tostring())
+	    #mkstemp makes the file readable by its owner only
+	    os.chmod(tempfilename, 0o644)
+	    if os.name == "nt" and os.path.isfile(peakfilename):
+		os.remove(peakfilename)
+	    os.rename(tempfilename, peakfilename)
+	except:
+	    if os.path.isfile(tempfilename):
+		os.remove(tempfilename)
+	    raise
+
+def ReadPeakFile(peakfilename):
+    '''Auxiliary function to read the header of a peak file written by
+    PeakPyramid.Save, returning a PeakPyramid that reads its levels from
+    the file as they are needed'''
+    with open(peakfilename, 'rb') as f:
+	header = f.read(peakfilestruct.size)
+	if len(header) < peakfilestruct.size:
+	    raise ValueError("{0} is not a peak file".format(peakfilename))
+	(magic, version, numchannels, sourcesize, sourcemtime, samplerate,
+	    numframes, basesamples, numlevels) = peakfilestruct.unpack(header)
+	if magic != peakfilemagic or version != peakfileversion:
+	    raise ValueError("{0} is not a version {1} peak file".format(
+		peakfilename, peakfileversion))
+	counts = f.read(8 * numlevels)
+	if len(counts) < 8 * numlevels:
+	    raise ValueError("{0} is truncated".format(peakfilename))
+    pyramid = PeakPyramid(samplerate, numchannels, basesamples)
+    pyramid.numframes = numframes
+    pyramid.sourcesize = sourcesize
+    pyramid.sourcemtime = sourcemtime
+    pyramid.counts = list(unpack("<{0}Q".format(numlevels), counts))
+    pyramid.levels = [None] * numlevels
+    offset = peakfilestruct.size + 8 * numlevels
+    for count in pyramid.counts:
+	pyramid.offsets.append(offset)
+	offset += count * numchannels * 4
+    pyramid.peakfilename = peakfilename
+    return pyramid
 
 class CDPFile:
     """Class implementation of chunked BWF wave file to ContentDepot(TM) specs"""
@@ -516,28 +1263,191 @@ class CDPFile:
 	self.audiopointer = 0
 	self.wavefilename = ""
 	self.audiosrcfilename = ""
+	self.copymethod = "auto"
+	#(chunktype, offset, size) of every chunk in the last file read
+	self.chunkmap = []
+	self.audiomap = None
+	self.frameindex = None
+	#(file name, offset, size) of the audio once trimmed or joined
+	self.audioranges = None
 
     def __str__(self):
 	return "---FMT Chunk---\n{0}\n---FACT Chunk---\n{1}\n---MEXT Chunk---" \
 		"\n{2}\n---BEXT Chunk---\n{3}\n---CART Chunk---" \
 		"\n{4}\n".format(self.fmt, self.fact, self.mext, self.bext, self.cart)
 
+    def ExportFieldDict(self, chunknames=("fmt", "fact", "mext", "bext",
+	    "cart")):
+	"""Return a dict of chunk name to a dict of its field values, with
+	post timers as lists and binary strings as hex, ready to be
+	written out as JSON or CSV"""
+	chunks = dict()
+	for chunkname in chunknames:
+	    fields = dict()
+	    for field, value in getattr(self, chunkname).__dict__.iteritems():
+		if field == "xmlfields":
+		    continue
+		if field == "posttimers":
+		    value = [[str(postcode).strip("\x00"), sampleval]
+			     for postcode, sampleval in value]
+		elif isinstance(value, str) and re.search(
+			r'[\x00-\x08\x0b\x0c\x0e-\x1f]', value):
+		    value = value.encode("hex")
+		fields[field] = value
+	    chunks[chunkname] = fields
+	return chunks
+
     def ImportMpegFile(self, mpegfilename):
 	mpegheader, self.datasize = GetMPEGHeaderFromFile(mpegfilename)
 	self.audiosrcfilename = mpegfilename
+	self.audioranges = None
 	mpeginfo = MpegInfoDescriptor(mpegheader, self.datasize)
 	self.mext.GetMpegParam(mpeginfo)
 	self.fact.GetMpegParam(mpeginfo)
 	self.fmt.GetMpegParam(mpeginfo) 
-	
-    def ExportMpegFile(self, mpegfilename):
+	self.IndexMpegData()
+
+    def IndexMpegData(self):
+	"""Find every frame in the MPEG audio and set the fact sample count
+	and mext SoundInfo flags from the frames found"""
 	with open(self.audiosrcfilename, "rb") as f:
-	    with open(mpegfilename, "wb") as m:
-		f.seek(self.audiopointer)
-		audio = f.read(self.fmt.blockalign)
-		while (m.tell() < self.datasize) and audio:
-		    m.write(audio)
-		    audio = f.read(self.fmt.blockalign)
+	    f.seek(0, os.SEEK_END)
+	    if f.tell() == 0:
+		self.frameindex = MpegFrameIndex()
+		return self.frameindex
+	    audiomap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	try:
+	    self.frameindex = IndexMpegFrames(audiomap, self.audiopointer,
+		    self.audiopointer + self.datasize)
+	finally:
+	    audiomap.close()
+	self.fact.numsamples = self.frameindex.NumSamples()
+	self.mext.soundinfo = self.frameindex.SoundInfo()
+	return self.frameindex
+
+    def SeekTime(self, seconds):
+	"""Return the file offset of the MPEG frame playing at seconds"""
+	if self.frameindex is None:
+	    self.IndexMpegData()
+	return self.audiopointer + self.frameindex.TimeToOffset(seconds)
+	
+    def ExportMpegFile(self, mpegfilename, copymethod=None):
+	with open(mpegfilename, "wb") as m:
+	    for filename, offset, count in self.AudioRanges():
+		with open(filename, "rb") as f:
+		    CopyAudioData(f, m, offset, count,
+			    copymethod or self.copymethod)
+
+    def AudioRanges(self):
+	"""Return the (file name, offset, size) byte ranges that make up
+	the audio, in order"""
+	if self.audioranges is None:
+	    return [(self.audiosrcfilename, self.audiopointer, self.datasize)]
+	return self.audioranges
+
+    def SetAudioRanges(self, ranges):
+	"""Make the MPEG audio the given byte ranges played one after
+	another, and index their frames for the fact and mext chunks"""
+	self.audioranges = ranges
+	self.datasize = sum(count for filename, offset, count in ranges)
+	self.frameindex = IndexMpegRanges(ranges)
+	self.fact.numsamples = self.frameindex.NumSamples()
+	self.mext.soundinfo = self.frameindex.SoundInfo()
+
+    def MpegFrameBytes(self, first=0, last=None):
+	"""Return the byte range of frames first up to last of the audio,
+	leaving out anything that is not part of a frame"""
+	if self.fmt.compressioncode != 80:
+	    raise ValueError("Only MPEG audio can be cut at frames")
+	index = self.frameindex or self.IndexMpegData()
+	if last is None or last > len(index.offsets):
+	    last = len(index.offsets)
+	if first >= last:
+	    return 0, 0
+	if last == len(index.offsets):
+	    return index.offsets[first], index.datasize
+	return index.offsets[first], index.offsets[last]
+
+    def TrimMpeg(self, start=0.0, end=None):
+	"""Keep only the MPEG frames between the frame boundaries nearest
+	start and end seconds. No audio is read or copied until the file is
+	written. Post timers move with the audio, EOD is kept within the
+	new end and timers that fall outside are cleared"""
+	if self.fmt.compressioncode != 80:
+	    raise ValueError("Only MPEG audio can be trimmed")
+	index = self.frameindex or self.IndexMpegData()
+	first = index.NearestFrame(start)
+	last = None
+	if end is not None:
+	    last = max(first, index.NearestFrame(end))
+	startbyte, endbyte = self.MpegFrameBytes(first, last)
+	self.SetAudioRanges(SliceRanges(self.AudioRanges(), startbyte,
+					endbyte))
+	numsamples = self.frameindex.NumSamples()
+	shift = first * index.samplesperframe
+	timers = []
+	for postcode, sampleval in self.cart.posttimers:
+	    if postcode.strip("\x00"):
+		sampleval -= shift
+		if postcode == "EOD " and sampleval > numsamples:
+		    sampleval = numsamples
+		if not 0 <= sampleval <= numsamples:
+		    postcode, sampleval = "\x00" * 4, 0
+	    timers.append((postcode, sampleval))
+	self.cart.posttimers = timers
+
+    def AppendMpeg(self, other):
+	"""Add the MPEG frames of another CDPFile after this one's. Both
+	must have the same layer, bitrate, sample rate and mode. The other
+	file's post timers follow its audio into free slots, its MRK and
+	SECn becoming the next SECn, and its EOD replaces this one's"""
+	for field in ("compressioncode", "headlayer", "headbitrate",
+		"samplerate", "numchannels", "headmode", "heademphasis"):
+	    if getattr(self.fmt, field) != getattr(other.fmt, field):
+		raise InvalidMPEGDataError("Cannot join MPEG audio with"
+			" different {0}: {1} and {2}".format(field,
+			getattr(self.fmt, field), getattr(other.fmt, field)))
+	startbyte, endbyte = self.MpegFrameBytes()
+	otherstart, otherend = other.MpegFrameBytes()
+	shift = self.frameindex.NumSamples()
+	self.SetAudioRanges(SliceRanges(self.AudioRanges(), startbyte,
+		endbyte) + SliceRanges(other.AudioRanges(), otherstart,
+		otherend))
+	timers = list(self.cart.posttimers)
+	eodslot = None
+	for slot, (postcode, sampleval) in enumerate(timers):
+	    if postcode == "EOD ":
+		timers[slot] = ("\x00" * 4, 0)
+		eodslot = slot
+	#The other file's MRK and SECn start segments of the joined audio,
+	#so they carry on the SECn numbering; other codes this file already
+	#has are dropped
+	codes = set(code for code, value in timers)
+	section = max([int(code[3:]) for code in codes
+		       if re.match(r"SEC\d$", code)] + [0]) + 1
+	for postcode, sampleval in sorted(other.cart.posttimers,
+					  key=lambda timer: timer[1]):
+	    if not postcode.strip("\x00"):
+		continue
+	    if postcode == "EOD " and eodslot is not None:
+		slot = eodslot
+	    else:
+		free = [slot for slot, (code, value) in enumerate(timers)
+			if not code.strip("\x00") and slot != eodslot]
+		if not free:
+		    continue
+		slot = free[-1] if postcode == "EOD " else free[0]
+	    if ((postcode == "MRK " and postcode in codes) or
+		    re.match(r"SEC\d$", postcode)):
+		if section > 9:
+		    continue
+		postcode = "SEC{0}".format(section)
+		section += 1
+	    elif postcode != "EOD " and postcode in codes:
+		continue
+	    codes.add(postcode)
+	    timers[slot] = (postcode, sampleval + shift)
+	self.cart.posttimers = timers
 		    
     def __ReadWaveFile_old(self, wavefilename):
 	foundchunklist = []
@@ -616,12 +1526,34 @@ class CDPFile:
 
 	return foundchunklist
 
-    def ReadWaveFile(self, wavefilename):
+    def ReadRawChunks(self, wavefilename, chunknames=None):
+	"""Walk the chunks of a wave file, setting chunkmap, audiopointer
+	and datasize, and return a dict of the undecoded data of each
+	header chunk this class knows (or only those named in chunknames)"""
+	#Let any arrays still using the old map keep it alive
+	self.audiomap = None
+	self.frameindex = None
+	self.audioranges = None
+	(self.chunkmap, audiopointer, datasize,
+	 rawchunks) = ReadChunkData(wavefilename, chunknames)
+	if audiopointer is not None:
+	    self.audiopointer = audiopointer
+	    self.datasize = datasize
+	self.audiosrcfilename = wavefilename
+	return rawchunks
+
+    def DecodeRawChunks(self, rawchunks):
+	"""Decode a dict of chunk name to chunk data into the chunk objects"""
+	for chunkname, data in rawchunks.iteritems():
+	    getattr(self, chunkname).DecodeBinString(data, len(data))
+
+    def ReadWaveFile(self, wavefilename, chunknames=None):
 	#Open wave file
-	with open( wavefilename, 'rb') as f:
-	    data = f.read(8192)
-	#foundchunklist = self.SearchWaveDataBlob( data )
-	foundchunklist = self.MakeChunkDictionary(data)
+	self.DecodeRawChunks(self.ReadRawChunks(wavefilename, chunknames))
+	foundchunklist = []
+	for chunktype, offset, chunksize in self.chunkmap:
+	    if chunktype.rstrip() not in foundchunklist:
+		foundchunklist.append(chunktype.rstrip())
 	if self.fmt.compressioncode == 80:
 	    self.audiosrcfilename = wavefilename
 	else:
@@ -629,50 +1561,932 @@ class CDPFile:
 
 	return foundchunklist
 
-    def WriteWaveFileHelper(self, wavefilename, chunklist, inputfile):
+    def EncodeWaveHeader(self, chunklist):
         #ChunkList = (self.fmt, self.fact, self.mext, self.bext, self.cart)
 	#Chunks = [chunk.EncodeBinString() for chunk in ChunkList]
 	#ChunkStuff = zip(["fmt ", "fact", "mext", "bext", "cart"], Chunks)
 	HeaderString = ""
 	for chunkname in chunklist:
 	    chunkstring = getattr(self, str(chunkname).strip(" ")).EncodeBinString()
-	    HeaderString = HeaderString + chunkname + pack("L", len(chunkstring)) + chunkstring
-	HeaderString = HeaderString + chunkname + pack("L", len(chunkstring)) + chunkstring
-	HeaderString = HeaderString + "data" + pack("L", self.datasize)
+	    HeaderString = HeaderString + chunkname + pack("<L", len(chunkstring)) + chunkstring
+	HeaderString = HeaderString + chunkname + pack("<L", len(chunkstring)) + chunkstring
+	HeaderString = HeaderString + "data" + pack("<L", self.datasize)
 
-	HeaderString = "RIFF" + pack("L", len(HeaderString) + self.datasize + 4) \
+	HeaderString = "RIFF" + pack("<L", len(HeaderString) + self.datasize + 4) \
 	               + "WAVE" + HeaderString
+	return HeaderString
 
-	with open(inputfile, 'rb') as m:
-	    with open(wavefilename, 'wb') as f:
-		f.write(HeaderString)
-		m.seek(self.audiopointer)
-		audio = m.read(self.fmt.blockalign)
-		while audio:
-		    f.write(audio)
-		    audio = m.read(self.fmt.blockalign)
-		if (self.datasize % 2) == 1:
-		    f.write('\x00')
-
-    def WriteCompressedWaveFile(self, wavefilename):
+    def WriteWaveFileHelper(self, wavefilename, chunklist, inputfile,
+	    copymethod=None, analyzer=None, ranges=None):
+	"""Write the headers and copy the audio, from inputfile or from the
+	(file name, offset, size) byte ranges given, one after another. If
+	an analyzer is given it sees the audio as it is copied, its results
+	are stored with SetLoudnessFields and the headers are written
+	again"""
+	if ranges is None:
+	    ranges = [(inputfile, self.audiopointer, self.datasize)]
+	for filename, offset, count in ranges:
+	    if (os.path.exists(wavefilename) and
+		    os.path.exists(filename) and
+		    os.path.samefile(wavefilename, filename)):
+		raise IOError("Cannot write {0} over its own audio".format(
+		    wavefilename))
+	HeaderString = self.EncodeWaveHeader(chunklist)
+	with open(wavefilename, 'wb') as f:
+	    f.write(HeaderString)
+	    copied = 0
+	    for filename, offset, count in ranges:
+		with open(filename, 'rb') as m:
+		    if analyzer is None:
+			copied += CopyAudioData(m, f, offset, count,
+				copymethod or self.copymethod)
+		    else:
+			copied += CopyAudioData(m, f, offset, count,
+				blockfunc=analyzer.AddData)
+	    if (copied % 2) == 1:
+		f.write('\x00')
+	    if analyzer is not None:
+		results = analyzer.Results()
+		self.SetLoudnessFields(results)
+		#The loudness fields do not change the header size
+		f.seek(0)
+		f.write(self.EncodeWaveHeader(chunklist))
+		return results
+
+    def WriteCompressedWaveFile(self, wavefilename, copymethod=None):
 	chunklist = ["fmt ", "fact", "mext", "bext", "cart"]
-	self.WriteWaveFileHelper(wavefilename, chunklist, self.audiosrcfilename)
+	self.WriteWaveFileHelper(wavefilename, chunklist, self.audiosrcfilename,
+		copymethod, ranges=self.audioranges)
 
-    def WritePCMWaveFile(self, wavefilename):
+    def WritePCMWaveFile(self, wavefilename, copymethod=None, analyze=False):
+	"""Write a PCM wave file. With analyze, the audio is measured while
+	it is copied and the PCMAnalyzer results are returned"""
 	chunklist = ["fmt ", "bext", "cart"]
-	self.WriteWaveFileHelper(wavefilename, chunklist, self.audiosrcfilename)
+	analyzer = None
+	if analyze:
+	    analyzer = self.MakePCMAnalyzer()
+	return self.WriteWaveFileHelper(wavefilename, chunklist,
+		self.audiosrcfilename, copymethod, analyzer, self.audioranges)
+
+    def MakePCMAnalyzer(self):
+	if numpy is None:
+	    raise ImportError("NumPy is needed to analyze PCM data")
+	return PCMAnalyzer(self.fmt)
+
+    def AnalyzePCM(self, buffersize=copybuffersize):
+	"""Read the PCM data once, store the levels found with
+	SetLoudnessFields and return the PCMAnalyzer results"""
+	analyzer = self.MakePCMAnalyzer()
+	with open(self.audiosrcfilename, 'rb') as f:
+	    f.seek(self.audiopointer)
+	    remaining = self.datasize
+	    while remaining > 0:
+		data = f.read(min(buffersize, remaining))
+		if not data:
+		    break
+		analyzer.AddData(data)
+		remaining -= len(data)
+	results = analyzer.Results()
+	self.SetLoudnessFields(results)
+	return results
+
+    def AudioLevels(self, blockseconds=levelblockseconds):
+	"""Return an array of the level in dBFS of each block of the audio
+	and the number of samples in a block. PCM is measured by the RMS
+	of the loudest channel in blocks of blockseconds, and MPEG Layer
+	II by MpegLayer2Levels a frame at a time"""
+	if numpy is None:
+	    raise ImportError("NumPy is needed to measure audio levels")
+	if self.fmt.compressioncode == 80:
+	    if self.frameindex is None:
+		self.IndexMpegData()
+	    offsets = numpy.array(self.frameindex.offsets, numpy.int64)
+	    levels = [numpy.zeros(0)]
+	    position = 0
+	    for filename, offset, count in self.AudioRanges():
+		inrange = offsets[(offsets >= position) &
+				  (offsets < position + count)]
+		if len(inrange):
+		    with open(filename, "rb") as f:
+			audiomap = mmap.mmap(f.fileno(), 0,
+				access=mmap.ACCESS_READ)
+		    try:
+			levels.append(MpegLayer2Levels(audiomap,
+				inrange - position, offset))
+		    finally:
+			audiomap.close()
+		position += count
+	    return (numpy.concatenate(levels),
+		    self.frameindex.samplesperframe)
+	decoder = PCMDecoder(self.fmt)
+	blockframes = max(1, int(round(blockseconds * self.fmt.samplerate)))
+	blocksize = blockframes * self.fmt.blockalign
+	readsize = blocksize * max(1, copybuffersize // blocksize)
+	powers = []
+	with open(self.audiosrcfilename, 'rb') as f:
+	    f.seek(self.audiopointer)
+	    remaining = self.datasize - self.datasize % self.fmt.blockalign
+	    while remaining > 0:
+		data = f.read(min(readsize, remaining))
+		if not data:
+		    break
+		remaining -= len(data)
+		samples = decoder.DecodeSamples(buffer(data, 0,
+			len(data) - len(data) % self.fmt.blockalign))
+		samples *= samples
+		whole = len(samples) // blockframes
+		powers.append(samples[:whole * blockframes].reshape(whole,
+			blockframes, -1).mean(axis=1).max(axis=1))
+		if whole * blockframes < len(samples):
+		    powers.append(samples[whole * blockframes:].mean(
+			    axis=0).max(axis=0, keepdims=True))
+	if not powers:
+	    return numpy.zeros(0), blockframes
+	with numpy.errstate(divide="ignore"):
+	    return 10 * numpy.log10(numpy.concatenate(powers)), blockframes
+
+    def DetectPostTimers(self, threshold=silencethreshold, gap=silencegap):
+	"""Propose post timers from the audio levels, as a list of eight
+	(code, sample) pairs for cart.posttimers: MRK where the audio
+	starts, SEC1 to SEC6 where it resumes after gaps of gap seconds
+	below threshold dBFS, and EOD where it ends, in the last slot.
+	Returns None if no audio is above threshold"""
+	levels, blocksamples = self.AudioLevels()
+	if self.fmt.compressioncode == 80:
+	    numsamples = self.frameindex.NumSamples()
+	else:
+	    numsamples = self.datasize // self.fmt.blockalign
+	gapblocks = max(1, int(round(gap * self.fmt.samplerate /
+				     blocksamples)))
+	found = SilenceTimers(levels, blocksamples, numsamples, threshold,
+		gapblocks)
+	if not found:
+	    return None
+	timers = [("\x00" * 4, 0)] * 8
+	#MRK and as many SECn as fit before EOD
+	starts = found[:-1][:7]
+	timers[:len(starts)] = starts
+	timers[7] = found[-1]
+	return timers
+
+    def PeakFileName(self):
+	return self.audiosrcfilename + peakfileextension
+
+    def BuildPeaks(self, peakfilename=None, basesamples=peakbasesamples):
+	"""Read the PCM data once, build a PeakPyramid of it, save it to the
+	peak file next to the audio (or to peakfilename) and return it"""
+	if numpy is None:
+	    raise ImportError("NumPy is needed to build waveform peaks")
+	decoder = PCMDecoder(self.fmt)
+	status = os.stat(self.audiosrcfilename)
+	pyramid = PeakPyramid(self.fmt.samplerate, self.fmt.numchannels,
+		basesamples)
+	pyramid.sourcesize = status.st_size
+	pyramid.sourcemtime = status.st_mtime
+	peaksize = basesamples * self.fmt.blockalign
+	readsize = peaksize * max(1, copybuffersize // peaksize)
+	parts = []
+	with open(self.audiosrcfilename, 'rb') as f:
+	    f.seek(self.audiopointer)
+	    remaining = self.datasize - self.datasize % self.fmt.blockalign
+	    while remaining > 0:
+		data = f.read(min(readsize, remaining))
+		if not data:
+		    break
+		remaining -= len(data)
+		samples = decoder.DecodeInt16Samples(buffer(data, 0,
+			len(data) - len(data) % self.fmt.blockalign))
+		pyramid.numframes += len(samples)
+		#Only the last read can end part way through a peak
+		blocks = [samples[:len(samples) - len(samples) %
+			basesamples].reshape(-1, basesamples,
+			self.fmt.numchannels)]
+		if len(samples) % basesamples:
+		    blocks.append(samples[len(blocks[0]) *
+			    basesamples:][None])
+		for block in blocks:
+		    peaks = numpy.empty((len(block), self.fmt.numchannels, 2),
+					numpy.int16)
+		    peaks[:, :, 0] = block.min(axis=1)
+		    peaks[:, :, 1] = block.max(axis=1)
+		    parts.append(peaks)
+	if parts:
+	    pyramid.SetBaseLevel(numpy.concatenate(parts))
+	else:
+	    pyramid.SetBaseLevel(numpy.zeros((0, self.fmt.numchannels, 2),
+					     numpy.int16))
+	pyramid.Save(peakfilename or self.PeakFileName())
+	return pyramid
+
+    def LoadPeaks(self, peakfilename=None):
+	"""Return the PeakPyramid from the peak file if it was built from
+	the audio file as it is now, going by its size and modification
+	time, or build a new one"""
+	peakfilename = peakfilename or self.PeakFileName()
+	status = os.stat(self.audiosrcfilename)
+	try:
+	    pyramid = ReadPeakFile(peakfilename)
+	    if (pyramid.sourcesize == status.st_size and
+		    pyramid.sourcemtime == status.st_mtime):
+		return pyramid
+	except (IOError, ValueError):
+	    pass
+	return self.BuildPeaks(peakfilename)
+
+    def WaveformPeaks(self, width, start=0.0, end=None):
+	"""Return at most width columns of (min, max) int16 peaks per
+	channel for the audio from start to end seconds, served from the
+	peak file, which is built first if it is missing or stale"""
+	pyramid = self.LoadPeaks()
+	first = int(start * pyramid.samplerate)
+	if end is None:
+	    return pyramid.Columns(width, first)
+	return pyramid.Columns(width, first, int(end * pyramid.samplerate))
+
+    def SetLoudnessFields(self, results):
+	"""Store PCMAnalyzer results in the bext version 2 loudness fields,
+	and the peak sample value in the cart zerodbref"""
+	self.bext.version = max(self.bext.version, 2)
+	for field, result in (("loudnessvalue", "loudness"),
+		("loudnessrange", "loudnessrange"),
+		("maxtruepeaklevel", "truepeak"),
+		("maxmomentaryloudness", "maxmomentary"),
+		("maxshorttermloudness", "maxshortterm")):
+	    self.bext.SetLoudness(field, results[result])
+	if results["peaksample"] is not None:
+	    self.cart.zerodbref = results["peaksample"]
+
+    def MapPCMData(self):
+	"""Return the samples of a PCM data chunk as a read-only NumPy array
+	of shape (frames, channels). The array is a view on a memory map of
+	the file, so no audio is read until it is used"""
+	if numpy is None:
+	    raise ImportError("NumPy is needed to map PCM data")
+	try:
+	    dtype = pcmdtypes[(self.fmt.compressioncode,
+		self.fmt.bitspersample)]
+	except KeyError:
+	    raise ValueError("Cannot map {0} bit audio with compression code"
+		    " {1}".format(self.fmt.bitspersample,
+		    self.fmt.compressioncode))
+	if self.audiomap is None:
+	    with open(self.audiosrcfilename, "rb") as f:
+		self.audiomap = mmap.mmap(f.fileno(), 0,
+			access=mmap.ACCESS_READ)
+	frames = self.datasize // self.fmt.blockalign
+	frames = min(frames, (len(self.audiomap) - self.audiopointer) //
+		self.fmt.blockalign)
+	return numpy.frombuffer(self.audiomap, dtype,
+		frames * self.fmt.numchannels, self.audiopointer).reshape(
+		frames, self.fmt.numchannels)
+
+    def GetPCMFrames(self, start=0.0, end=None):
+	"""Return a view of the PCM samples from start to end seconds"""
+	samples = self.MapPCMData()
+	if end is None:
+	    return samples[int(start * self.fmt.samplerate):]
+	return samples[int(start * self.fmt.samplerate):
+		       int(end * self.fmt.samplerate)]
+
+    def UnmapPCMData(self):
+	"""Close the memory map behind MapPCMData. Arrays returned earlier
+	must not be used afterwards"""
+	if self.audiomap is not None:
+	    self.audiomap.close()
+	    self.audiomap = None
+
+    def WalkChunks(self, f):
+	"""Return (chunktype, offset, size) for every chunk in the open wave
+	file f, where offset is the position of the chunk data"""
+	return WalkChunks(f)
+
+    def UpdateHeadersInPlace(self, wavefilename=None,
+	    chunknames=("cart", "bext"), copymethod=None):
+	"""Write the named chunks back into an existing wave file without
+	copying the audio. Each chunk is patched in place if the new data
+	fits in the old chunk, or in the old chunk plus a JUNK chunk right
+	after it; otherwise the whole file is rewritten. Returns True if
+	the file was patched and False if it had to be rewritten, copying
+	the audio with copymethod"""
+	if wavefilename is None:
+	    wavefilename = self.audiosrcfilename
+	if self.audioranges is not None:
+	    #Trimmed or joined audio always needs a new file
+	    return self.RewriteWaveFile(wavefilename, copymethod)
+	patches = []
+	with open(wavefilename, 'rb') as f:
+	    chunks = self.WalkChunks(f)
+	    f.seek(0, os.SEEK_END)
+	    filesize = f.tell()
+	for chunkname in chunknames:
+	    chunkstring = getattr(self, chunkname).EncodeBinString()
+	    found = False
+	    for i, (chunktype, offset, chunksize) in enumerate(chunks):
+		if chunktype.rstrip() != chunkname:
+		    continue
+		found = True
+		if i + 1 < len(chunks):
+		    space = chunks[i + 1][1] - 8 - offset
+		else:
+		    space = filesize - offset
+		if (i + 1 < len(chunks) and chunks[i + 1][0] in junkchunks
+			and space - chunksize <= 1):
+		    junktype, junkoffset, junksize = chunks[i + 1]
+		    if i + 2 < len(chunks):
+			space = chunks[i + 2][1] - 8 - offset
+		    else:
+			space = junkoffset + junksize - offset
+		if len(chunkstring) <= chunksize:
+		    #Cart and bext strip trailing nulls when decoding
+		    patches.append((offset, chunktype, chunkstring + "\x00" *
+			(chunksize - len(chunkstring)), ""))
+		elif len(chunkstring) <= space:
+		    newsize = len(chunkstring) + len(chunkstring) % 2
+		    if space - newsize >= 8:
+			patches.append((offset, chunktype, chunkstring +
+			    "\x00" * (newsize - len(chunkstring)),
+			    "JUNK" + pack("<L", space - newsize - 8)))
+		    else:
+			patches.append((offset, chunktype, chunkstring +
+			    "\x00" * (space - len(chunkstring)), ""))
+		else:
+		    found = False
+		    break
+	    if not found:
+		break
+	else:
+	    with open(wavefilename, 'r+b') as f:
+		for offset, chunktype, chunkstring, junkheader in patches:
+		    f.seek(offset - 8)
+		    f.write(chunktype + pack("<L", len(chunkstring)) +
+			    chunkstring + junkheader)
+		f.seek(4)
+		riffsize, = unpack("<L", f.read(4))
+		if riffsize != filesize - 8:
+		    f.seek(4)
+		    f.write(pack("<L", filesize - 8))
+		self.chunkmap = self.WalkChunks(f)
+	    return True
+	return self.RewriteWaveFile(wavefilename, copymethod)
+
+    def RewriteWaveFile(self, wavefilename, copymethod=None):
+	"""Write the whole file again through a temporary file that then
+	replaces it, and read back where its chunks are. Returns False"""
+	tempfilename = wavefilename + ".tmp"
+	if self.fmt.compressioncode == 1:
+	    self.WritePCMWaveFile(tempfilename, copymethod)
+	else:
+	    self.WriteCompressedWaveFile(tempfilename, copymethod)
+	if os.name == "nt":
+	    os.remove(wavefilename)
+	os.rename(tempfilename, wavefilename)
+	self.audiosrcfilename = wavefilename
+	self.audioranges = None
+	with open(wavefilename, 'rb') as f:
+	    self.chunkmap = self.WalkChunks(f)
+	for chunktype, offset, chunksize in self.chunkmap:
+	    if chunktype == "data":
+		self.audiopointer = offset
+	return False
+
+class ChunkView(object):
+    """Class giving read-only access to the fields of a chunk kept as its
+    raw bytes. A field is decoded each time it is read and never stored,
+    so a view costs little more than the bytes themselves"""
+    __slots__ = ("schema", "data")
+    def __init__(self, schema, data):
+	self.schema = schema
+	self.data = data
+
+    def __getattr__(self, name):
+	schema = self.schema
+	if name in schema.absent:
+	    return schema.absent[name]
+	if name not in schema.offsets and name != schema.tail:
+	    raise AttributeError(name)
+	value = schema.Field(self.data, name)
+	if name == "posttimers":
+	    timers = CartChunk.posttimerstruct.unpack(value)
+	    return zip(timers[0::2], timers[1::2])
+	if schema.stripnuls and isinstance(value, str):
+	    return value.strip("\x00")
+	return value
+
+class HeaderView(object):
+    """Class giving read-only, lazily decoded access to the header chunks
+    of a wave file, as returned by ReadHeaderView. view.cart is a
+    ChunkView of the cart chunk, or None if the file has none"""
+    __slots__ = ("path", "chunkmap", "audiopointer", "datasize", "raw")
+    def __init__(self, path, chunkmap, audiopointer, datasize, raw):
+	self.path = path
+	self.chunkmap = chunkmap
+	self.audiopointer = audiopointer
+	self.datasize = datasize
+	self.raw = raw
+
+    def __getattr__(self, name):
+	if name not in headerchunks:
+	    raise AttributeError(name)
+	data = self.raw.get(name)
+	if data is None:
+	    return None
+	if name == "fmt":
+	    if len(data) not in FmtChunk.schemas:
+		raise Exception("Could not decode FMT chunk")
+	    return ChunkView(FmtChunk.schemas[len(data)], data)
+	return ChunkView({"cart": CartChunk, "bext": BextChunk,
+			  "mext": MextChunk, "fact": FactChunk}[name].schema,
+			 data)
+
+    def MakeCDPFile(self):
+	"""Return a CDPFile with every chunk of the view decoded"""
+	MyCDPFile = CDPFile()
+	MyCDPFile.chunkmap = self.chunkmap
+	if self.audiopointer is not None:
+	    MyCDPFile.audiopointer = self.audiopointer
+	    MyCDPFile.datasize = self.datasize
+	MyCDPFile.audiosrcfilename = self.path
+	MyCDPFile.DecodeRawChunks(self.raw)
+	return MyCDPFile
+
+def ReadHeaderView(wavefilename, chunknames=None):
+    """Read the header chunks of a wave file (or only those named in
+    chunknames) into a HeaderView without decoding any of them"""
+    chunkmap, audiopointer, datasize, rawchunks = ReadChunkData(
+	wavefilename, chunknames)
+    return HeaderView(wavefilename, chunkmap, audiopointer, datasize,
+		      rawchunks)
+
+def ReadHeadersBulk(paths, chunknames=("fmt", "bext", "cart")):
+    """Read the fixed part of the named header chunks of many wave files
+    into columns. Returns a dict with
+
+    paths: the paths, in the order of the rows below
+    one NumPy structured array per chunk name, laid out like its schema
+	(fmt always in the 40 byte layout, shorter fmt chunks NUL padded),
+	with a zeroed row for a file without that chunk
+    files: a structured array of audiopointer and datasize, error, and
+	for each chunk name <name>_present, <name>_size and, for chunks
+	with a variable length tail (cart tag text, bext coding history),
+	<name>_tailoffset and <name>_tailsize giving where it is in the file
+    errors: a dict of row number to the error that made a file unreadable
+
+    String columns drop their NUL padding, so filters are vectorised:
+    headers["cart"]["enddate"] < time.strftime("%Y/%m/%d")"""
+    if numpy is None:
+	raise ImportError("NumPy is needed to read headers in bulk")
+    schemas = dict((name, FmtChunk.schemas[40] if name == "fmt" else
+		    {"cart": CartChunk, "bext": BextChunk, "mext": MextChunk,
+		     "fact": FactChunk}[name].schema)
+		   for name in chunknames)
+    filefields = [("audiopointer", "<u8"), ("datasize", "<u8"),
+		  ("error", "?")]
+    for name in chunknames:
+	filefields.extend([(name + "_present", "?"), (name + "_size", "<u4")])
+	if schemas[name].tail is not None:
+	    filefields.extend([(name + "_tailoffset", "<u8"),
+			       (name + "_tailsize", "<u4")])
+    paths = list(paths)
+    files = numpy.zeros(len(paths), filefields)
+    parts = dict((name, []) for name in chunknames)
+    errors = dict()
+    readsizes = dict((name, schemas[name].size) for name in chunknames)
+    for row, path in enumerate(paths):
+	try:
+	    chunkmap, audiopointer, datasize, rawchunks = ReadChunkData(path,
+		chunknames, readsizes)
+	except Exception as inst:
+	    errors[row] = inst
+	    files["error"][row] = True
+	    rawchunks = dict()
+	    chunkmap = []
+	else:
+	    files["audiopointer"][row] = audiopointer or 0
+	    files["datasize"][row] = datasize or 0
+	offsets = dict((chunktype.rstrip(), (offset, chunksize))
+		       for chunktype, offset, chunksize in chunkmap)
+	for name in chunknames:
+	    size = schemas[name].size
+	    data = rawchunks.get(name, "")
+	    if name in rawchunks:
+		offset, chunksize = offsets[name]
+		files[name + "_present"][row] = True
+		files[name + "_size"][row] = chunksize
+		if schemas[name].tail is not None:
+		    files[name + "_tailoffset"][row] = offset + size
+		    files[name + "_tailsize"][row] = max(0, chunksize - size)
+		if len(data) < size and name != "fmt":
+		    errors[row] = IOError("{0} chunk is too short".format(
+					  name))
+		    files["error"][row] = True
+	    parts[name].append(data + "\x00" * (size - len(data)))
+    headers = dict((name, numpy.frombuffer("".join(parts[name]),
+		    schemas[name].Dtype()).copy()) for name in chunknames)
+    headers["paths"] = paths
+    headers["files"] = files
+    headers["errors"] = errors
+    return headers
+
+def ReadChunkData(wavefilename, chunknames=None, readsizes=None):
+    """Walk the chunks of a wave file. Returns the chunk map, the offset
+    and size of the audio (None, None without a data chunk) and a dict of
+    the undecoded data of each header chunk in headerchunks (or only
+    those named in chunknames). readsizes limits how much of a chunk is
+    read, by chunk name"""
+    rawchunks = dict()
+    audiopointer = datasize = None
+    with open( wavefilename, 'rb') as f:
+	chunkmap = WalkChunks(f)
+	f.seek(0, os.SEEK_END)
+	filesize = f.tell()
+	#If a chunk appears more than once the last one wins
+	lastchunks = dict()
+	for chunktype, offset, chunksize in chunkmap:
+	    lastchunks[chunktype.rstrip()] = (offset, chunksize)
+	for chunkname, (offset, chunksize) in lastchunks.iteritems():
+	    if chunkname == "data":
+		audiopointer = offset
+		datasize = min(chunksize, filesize - offset)
+	    elif chunkname in headerchunks and (chunknames is None or
+		    chunkname in chunknames):
+		f.seek(offset)
+		if readsizes is not None and chunkname in readsizes:
+		    chunksize = min(chunksize, readsizes[chunkname])
+		rawchunks[chunkname] = f.read(chunksize)
+    return chunkmap, audiopointer, datasize, rawchunks
+
+def WalkChunks(f):
+    """Return (chunktype, offset, size) for every chunk in the open wave
+    file f, where offset is the position of the chunk data. Only the
+    8 byte chunk headers are read, everything else is seeked past"""
+    f.seek(0, os.SEEK_END)
+    filesize = f.tell()
+    f.seek(0)
+    riff, riffsize, wave = unpack("<4sL4s", f.read(12))
+    if riff != "RIFF" or wave != "WAVE":
+	raise IOError("Not a RIFF WAVE file")
+    chunks = []
+    ptr = 12
+    while ptr + 8 <= filesize:
+	f.seek(ptr)
+	chunktype, chunksize = unpack("<4sL", f.read(8))
+	if re.match(r'[ -~]{4}$', chunktype) is None:
+	    #Not a chunk header, most likely a bad size on the last chunk
+	    break
+	chunks.append((chunktype, ptr + 8, chunksize))
+	ptr += 8 + chunksize
+	if chunksize % 2 == 1 and ptr < filesize:
+	    #Older versions of this library did not pad odd sized
+	    #chunks, so only skip the pad byte if it is really there
+	    f.seek(ptr)
+	    if f.read(1) == "\x00":
+		ptr += 1
+    return chunks
+
+def XMLText(value):
+    """Return a byte string field as text ElementTree can write. The bytes
+    are read as Latin-1 so any value survives a round trip"""
+    if isinstance(value, str):
+	return value.decode("latin-1")
+    return value
+
+def IsJSONLName(filename):
+    return re.match(r'.*\.(jsonl|json)$', filename, re.I) is not None
+
+def WriteCartSidecar(sidecarfilename, records):
+    """Write (file name, CartChunk) records as they come to one sidecar,
+    JSONL if the name ends in .jsonl or .json, otherwise XML with a
+    <cart file="..."> element per record in a <carts> element. Returns
+    the number of records written"""
+    count = 0
+    jsonl = IsJSONLName(sidecarfilename)
+    with open(sidecarfilename, 'wb') as f:
+	if not jsonl:
+	    f.write('<?xml version="1.0" ?>\n<carts>\n')
+	for filename, cart in records:
+	    if jsonl:
+		f.write(json.dumps({"file": filename,
+			"cart": cart.ExportDictValues()}, sort_keys=True,
+			encoding="latin-1") + "\n")
+	    else:
+		element = cart.ExportXMLElement()
+		element.set("file", XMLText(filename))
+		f.write(ElementTree.tostring(element) + "\n")
+	    count += 1
+	if not jsonl:
+	    f.write('</carts>\n')
+    return count
+
+def ReadCartSidecar(sidecarfilename):
+    """Yield (file name, CartChunk) for each record of a sidecar written by
+    WriteCartSidecar, reading one record at a time so memory use does not
+    grow with the number of records. A file written by ExportXMLValues is
+    read as one record with no file name"""
+    if IsJSONLName(sidecarfilename):
+	with open(sidecarfilename, 'rb') as f:
+	    for lineno, line in enumerate(f, 1):
+		if not line.strip():
+		    continue
+		try:
+		    record = json.loads(line)
+		    filename = record.get("file")
+		    values = record["cart"]
+		except (ValueError, KeyError, AttributeError) as inst:
+		    raise InvalidCartDataError("{0} line {1}: {2}".format(
+			    sidecarfilename, lineno, inst))
+		cart = CartChunk()
+		cart.ImportDictValues(values)
+		if isinstance(filename, unicode):
+		    filename = filename.encode("latin-1")
+		yield filename, cart
+	return
+    root = None
+    try:
+	for event, element in ElementTree.iterparse(sidecarfilename,
+						    ("start", "end")):
+	    if root is None:
+		root = element
+	    if event == "end" and element.tag == "cart":
+		cart = CartChunk()
+		cart.ImportXMLElement(element)
+		filename = element.get("file")
+		if isinstance(filename, unicode):
+		    filename = filename.encode("latin-1")
+		yield filename, cart
+		#Drop the records already read
+		element.clear()
+		root.clear()
+    except SyntaxError as inst:
+	raise InvalidCartDataError("{0}: {1}".format(sidecarfilename, inst))
 
 def GetMPEGHeaderFromFile(filename):
     '''Auxiliary function to get the mpeg header from an MPEG file'''
     with open(filename, "rb") as f:
 	possibleheader = f.read(4)
-	mpegheader, = unpack(">L", possibleheader)
-	headerbin = "{0:b}".format(mpegheader)
-	if re.match( r'1111111111.*', headerbin):
+	if len(possibleheader) == 4:
+	    mpegheader, = unpack(">L", possibleheader)
+	else:
+	    mpegheader = 0
+	if (mpegheader & 0xFFE00000) == 0xFFE00000:
 	    return possibleheader, os.path.getsize(filename)
 	else:
 	    raise InvalidMPEGDataError("No Sync Signal found at start of MPEG data")
 
+def CopyAudioData(src, dst, offset, count, method="auto",
+	buffersize=copybuffersize, blockfunc=None):
+    '''Copy count bytes starting at offset in the open file src to the
+    current position of the open file dst and return the number of bytes
+    copied. The method is one of the names in copymethods; the kernel-side
+    copies fall back to buffered reads if the filesystem does not support
+    them, and the copy stops early if src runs out of data. If blockfunc
+    is given, buffered reads are used and it is called with each block'''
+    if method not in copymethods:
+	raise ValueError("Unknown copy method '{0}'".format(method))
+    copied = 0
+    dst.flush()
+    kernelcopies = []
+    if method in ("auto", "copy_file_range") and blockfunc is None:
+	kernelcopies.append("copy_file_range")
+    if method in ("auto", "sendfile") and blockfunc is None:
+	kernelcopies.append("sendfile")
+    for kernelcopy in kernelcopies:
+	if not hasattr(os, kernelcopy):
+	    continue
+	try:
+	    while copied < count:
+		if kernelcopy == "sendfile":
+		    sent = os.sendfile(dst.fileno(), src.fileno(),
+			    offset + copied, count - copied)
+		else:
+		    sent = os.copy_file_range(src.fileno(), dst.fileno(),
+			    count - copied, offset + copied)
+		if sent == 0:
+		    break
+		copied += sent
+	    #The kernel moved the fd offset behind the file object's back
+	    dst.seek(0, os.SEEK_END)
+	    return copied
+	except OSError as inst:
+	    if inst.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+		    errno.EBADF, errno.EOPNOTSUPP, errno.ENOTSUP):
+		raise
+	    dst.seek(0, os.SEEK_END)
+    src.seek(offset + copied)
+    buf = bytearray(buffersize)
+    while copied < count:
+	if count - copied < buffersize:
+	    buf = bytearray(count - copied)
+	read = src.readinto(buf)
+	if not read:
+	    break
+	if read < len(buf):
+	    dst.write(buf[:read])
+	else:
+	    dst.write(buf)
+	if blockfunc is not None:
+	    blockfunc(buf if read == len(buf) else buf[:read])
+	copied += read
+    return copied
+
+def IndexMpegFrames(data, start=0, end=None):
+    '''Auxiliary function to build an MpegFrameIndex of the MPEG frames in
+    data[start:end], where data is a string or mmap. Frame offsets are
+    relative to start. Bytes that are not part of a frame are skipped'''
+    if end is None or end > len(data):
+	end = len(data)
+    index = MpegFrameIndex()
+    headerstruct = Struct(">L")
+    pos = start
+    insync = False
+    while pos + 4 <= end:
+	headerword, = headerstruct.unpack_from(data, pos)
+	frameinfo = MpegFrameLength(headerword)
+	if frameinfo is not None and not insync:
+	    #Only trust a sync word found by searching if the next frame
+	    #starts where this one says it ends
+	    nextpos = pos + frameinfo[0]
+	    if nextpos + 4 <= end and (MpegFrameLength(
+		    headerstruct.unpack_from(data, nextpos)[0]) is None):
+		frameinfo = None
+	if frameinfo is None or pos + frameinfo[0] > end:
+	    if (headerword & 0xFFE0F000) == 0xFFE00000:
+		index.freeformat = True
+	    insync = False
+	    nextpos = data.find("\xff", pos + 1, end)
+	    if nextpos < 0:
+		nextpos = end
+	    index.junkbytes += nextpos - pos
+	    pos = nextpos
+	    continue
+	insync = True
+	framelength, index.samplesperframe, index.samplerate = frameinfo
+	index.offsets.append(pos - start)
+	index.samplerates.add(index.samplerate)
+	index.bitrates.add(mpegbitrates[(int(mpegversions[
+	    (headerword >> 19) & 3]), mpeglayers[(headerword >> 17) & 3])][
+	    (headerword >> 12) & 15])
+	if headerword & 0x200:
+	    index.paddedframes += 1
+	pos += framelength
+	index.datasize = pos - start
+    if pos < end:
+	index.junkbytes += end - pos
+    return index
+
+def IndexMpegRanges(ranges):
+    '''Auxiliary function to build one MpegFrameIndex of the MPEG audio in
+    (file name, offset, size) byte ranges played one after another'''
+    index = MpegFrameIndex()
+    position = 0
+    for filename, offset, count in ranges:
+	if count == 0:
+	    continue
+	with open(filename, "rb") as f:
+	    audiomap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	try:
+	    index.Extend(IndexMpegFrames(audiomap, offset, offset + count),
+			 position)
+	finally:
+	    audiomap.close()
+	position += count
+    return index
+
+def SliceRanges(ranges, start, end):
+    '''Auxiliary function to cut (file name, offset, size) byte ranges
+    played one after another down to bytes start to end of the whole'''
+    sliced = []
+    position = 0
+    for filename, offset, count in ranges:
+	first = max(start, position)
+	last = min(end, position + count)
+	if first < last:
+	    sliced.append((filename, offset + first - position, last - first))
+	position += count
+    return sliced
+
+def ReadBitFields(raw, positions, widths):
+    '''Auxiliary function to read big endian bit fields of up to 9 bits
+    from a NumPy array of bytes at arrays of bit positions'''
+    last = len(raw) - 1
+    first = positions >> 3
+    words = ((raw[numpy.minimum(first, last)].astype(numpy.int32) << 8) |
+	     raw[numpy.minimum(first + 1, last)])
+    return (words >> (16 - (positions & 7) - widths)) & ((1 << widths) - 1)
+
+def MpegLayer2Layout(headerword):
+    '''Auxiliary function returning the layout of the side information of
+    Layer II frames with the given header, as (header bits, allocation
+    bits per slot, slot of each subband and channel, channels), or None
+    for other layers and free format streams'''
+    key = headerword & mpeglayer2layoutmask
+    if key in mpeglayer2layouts:
+	return mpeglayer2layouts[key]
+    layout = None
+    if MpegFrameLength(key) is not None:
+	fields = DecodeMpegHeader(key)
+	if fields["mpeglyr"] == 2:
+	    numchannels = 1 if fields["channelmode"] == 3 else 2
+	    perchannel = fields["bitrate"] // numchannels
+	    if fields["mpegver"] != 1:
+		table = "LSF"
+	    elif ((fields["samplerate"] == 48000 and perchannel >= 56) or
+		    56 <= perchannel <= 80):
+		table = "A"
+	    elif fields["samplerate"] != 48000 and perchannel >= 96:
+		table = "B"
+	    elif fields["samplerate"] != 32000 and perchannel <= 48:
+		table = "C"
+	    else:
+		table = "D"
+	    allocbits = mpeglayer2allocbits[table]
+	    bound = len(allocbits)
+	    if fields["channelmode"] == 1:
+		bound = min(bound, 4 * (fields["modeext"] + 1))
+	    #Subbands from the joint stereo bound up share one allocation
+	    slotbits = []
+	    slots = []
+	    for subband, bits in enumerate(allocbits):
+		for channel in range(numchannels):
+		    if subband < bound or channel == 0:
+			slotbits.append(bits)
+		    slots.append(len(slotbits) - 1)
+	    headerbits = 32 if fields["protectbit"] == "1" else 48
+	    layout = (headerbits, numpy.array(slotbits),
+		      numpy.array(slots), numchannels)
+    mpeglayer2layouts[key] = layout
+    return layout
+
+def MpegLayer2Levels(data, offsets, start=0, chunkframes=8192):
+    '''Auxiliary function to measure the level in dBFS of each Layer II
+    frame at offsets from start in data, a string or mmap, from the
+    largest scalefactor in the frame. Only the side information is read,
+    so the level does not depend on the bitrate. Frames with nothing
+    allocated are -inf and frames of other layers are NaN'''
+    raw = numpy.frombuffer(data, numpy.uint8)
+    offsets = numpy.asarray(offsets, numpy.int64) + start
+    offsets = offsets[offsets + 4 <= len(raw)]
+    levels = numpy.empty(len(offsets))
+    levels.fill(numpy.nan)
+    headers = ((raw[offsets].astype(numpy.uint32) << 24) |
+	       (raw[offsets + 1].astype(numpy.uint32) << 16) |
+	       (raw[offsets + 2].astype(numpy.uint32) << 8) |
+	       raw[offsets + 3]) & mpeglayer2layoutmask
+    for headerword in numpy.unique(headers):
+	layout = MpegLayer2Layout(int(headerword))
+	if layout is None:
+	    continue
+	headerbits, slotbits, slots, numchannels = layout
+	slotstarts = numpy.cumsum(slotbits) - slotbits
+	scalefactors = numpy.array(mpeglayer2scalefactors)
+	frames = numpy.nonzero(headers == headerword)[0]
+	for first in range(0, len(frames), chunkframes):
+	    rows = frames[first:first + chunkframes]
+	    base = offsets[rows] * 8 + headerbits
+	    allocations = ReadBitFields(raw, base[:, None] +
+		    slotstarts, slotbits)[:, slots]
+	    allocated = allocations != 0
+	    #Each allocated subband has a 2 bit scfsi, then its scalefactors
+	    base += slotbits.sum()
+	    widths = 2 * allocated
+	    scfsi = ReadBitFields(raw, base[:, None] + numpy.cumsum(widths,
+		    axis=1) - widths, 2)
+	    counts = scalefactors[scfsi] * allocated
+	    base += widths.sum(axis=1)
+	    widths = 6 * counts
+	    positions = base[:, None] + numpy.cumsum(widths, axis=1) - widths
+	    smallest = numpy.empty(counts.shape, numpy.int32)
+	    smallest.fill(63)
+	    for index in range(3):
+		smallest = numpy.where(counts > index, numpy.minimum(
+			smallest, ReadBitFields(raw, positions + 6 * index,
+			6)), smallest)
+	    smallest = smallest.min(axis=1)
+	    #Scalefactor n is 2 ** (1 - n / 3.0)
+	    levels[rows] = numpy.where(smallest < 63,
+		    20 * numpy.log10(2) * (1 - smallest / 3.0), -numpy.inf)
+    return levels
+
+def SilenceTimers(levels, blocksamples, numsamples,
+	threshold=silencethreshold, gapblocks=100):
+    '''Auxiliary function to propose post timers from the levels of blocks
+    of blocksamples samples. Returns (code, sample) pairs: MRK at the
+    start of the audio, SEC1, SEC2 and so on where the audio resumes after
+    each gap of at least gapblocks silent blocks, and EOD at the end of
+    the audio. Returns no timers if nothing is above threshold'''
+    loud = numpy.asarray(levels) > threshold
+    if not loud.any():
+	return []
+    loudblocks = numpy.nonzero(loud)[0]
+    timers = [("MRK ", int(loudblocks[0]) * blocksamples)]
+    #Gaps are the distances between consecutive loud blocks
+    gaps = numpy.nonzero(numpy.diff(loudblocks) > gapblocks)[0]
+    for segment, gap in enumerate(gaps, 1):
+	timers.append(("SEC{0}".format(segment),
+		       int(loudblocks[gap + 1]) * blocksamples))
+    timers.append(("EOD ", min(numsamples,
+			       (int(loudblocks[-1]) + 1) * blocksamples)))
+    return timers
+
 def RunTests():
     pass
 
@@ -39,10 +39,16 @@
 from cdpwavefile import *
 from optparse import OptionParser
 import sys
+import csv
+import json
+import time
+import multiprocessing
 
 program_version = "1.4"
 
-parser = OptionParser(usage="usage: %prog [options] PCM/MP2inputfile wrappedoutputfile")
+parser = OptionParser(usage="usage: %prog [options] PCM/MP2inputfile wrappedoutputfile\n"
+	"       %prog [options] wrappedfile (update the headers in place)\n"
+	"       %prog [options] --batch=MANIFEST")
 parser.add_option("-v", "--ver", dest="show_version",
 	action="store_true", default=False,
 	help="show program version")
@@ -78,57 +84,325 @@ parser.add_option("--tagtext-in", dest="tagtextinfile",
 parser.add_option("--restore-cart", dest="cart_xml_filename",
 	help="restore cart chunk info (minus TagText) from FILE",
 	metavar="FILE")
-(options, args) = parser.parse_args()
+parser.add_option("--copy-method", dest="copy_method", default="auto",
+	choices=copymethods,
+	help="copy audio using METHOD, one of {0}; default value is"
+	" auto".format(", ".join(copymethods)), metavar="METHOD")
+parser.add_option("--analyze", dest="analyze", action="store_true",
+	default=False,
+	help="measure the loudness and peak levels of PCM audio while it is"
+	" copied and store them in the bext loudness fields and the cart"
+	" 0 dB reference")
+parser.add_option("--auto-timers", dest="auto_timers", action="store_true",
+	default=False,
+	help="set the cart post timers from the audio: MRK where it starts,"
+	" SEC1, SEC2... where it resumes after a silent gap and EOD where it"
+	" ends")
+parser.add_option("--silence-threshold", dest="silence_threshold",
+	type="float", default=silencethreshold,
+	help="treat audio below DB dBFS as silence for --auto-timers,"
+	" default value is {0}".format(silencethreshold), metavar="DB")
+parser.add_option("--silence-gap", dest="silence_gap", type="float",
+	default=silencegap,
+	help="start a new segment after SECONDS of silence for"
+	" --auto-timers, default value is {0}".format(silencegap),
+	metavar="SECONDS")
+parser.add_option("--append", dest="append_files", action="append",
+	help="join the MP2 audio of FILE onto the end of the input file;"
+	" may be given more than once", metavar="FILE")
+parser.add_option("--start", dest="trim_start", type="float",
+	help="cut the MP2 audio to start at the frame boundary nearest"
+	" SECONDS", metavar="SECONDS")
+parser.add_option("--end", dest="trim_end", type="float",
+	help="cut the MP2 audio to end at the frame boundary nearest"
+	" SECONDS", metavar="SECONDS")
+parser.add_option("--batch", dest="manifest",
+	help="wrap every file listed in the CSV or JSONL file MANIFEST",
+	metavar="MANIFEST")
+parser.add_option("-j", "--workers", dest="workers", type="int",
+	default=multiprocessing.cpu_count(),
+	help="wrap up to N files at once in batch mode, default value is"
+	" the number of CPUs", metavar="N")
+parser.add_option("--status-log", dest="status_log",
+	help="write the result for each batch file to FILE, default value"
+	" is MANIFEST.log", metavar="FILE")
+parser.add_option("--restore-carts", dest="carts_filename",
+	help="restore the cart chunk (minus TagText) of every file listed"
+	" in the XML or JSONL sidecar SIDECAR written by readcondep"
+	" --save-carts", metavar="SIDECAR")
+
+#Manifest columns that are not CartChunk fields
+manifestcolumns = ("input", "output", "cart", "tagtext")
+
+def ReadInputFile(inputfile):
+    """Return a CDPFile read from an .mp2 or .wav file"""
+    MyCDPFile = CDPFile()
+    MyCDPFile.cart.tagtext = ""
+    if re.match(r'.*\.mp2$', inputfile, re.I) is not None:
+	MyCDPFile.ImportMpegFile(inputfile)
+    elif re.match(r'.*\.wav$', inputfile, re.I) is not None:
+	MyCDPFile.ReadWaveFile(inputfile)
+    else:
+	raise Exception("Unrecognized filename extension on file: {0}".format(
+	    inputfile))
+    return MyCDPFile
+
+def WrapFile(inputfile, outputfile, overrides, cart_xml_filename=None,
+	tagtextinfile=None, copymethod="auto", verbose=True, analyze=False,
+	autotimers=None, appendfiles=(), start=None, end=None):
+    """Wrap inputfile into outputfile, or update its headers in place if
+    outputfile is the same file or None, applying the CartChunk values
+    in the overrides dict. With analyze, PCM audio is measured in the same
+    pass and the PCMAnalyzer results are returned. If autotimers is a dict
+    of DetectPostTimers arguments, the post timers are set from the audio.
+    The MPEG audio of appendfiles is joined on, then the result is cut to
+    the frames between start and end seconds"""
+    inplace = outputfile is None or outputfile == inputfile
+    MyCDPFile = ReadInputFile(inputfile)
+    for appendfile in appendfiles:
+	MyCDPFile.AppendMpeg(ReadInputFile(appendfile))
+	if verbose:
+	    print "Appended {0}".format(appendfile)
+    if start is not None or end is not None:
+	MyCDPFile.TrimMpeg(start or 0.0, end)
+	if verbose:
+	    print "Trimmed to {0:.3f} seconds".format(
+		    MyCDPFile.frameindex.Duration())
+    if cart_xml_filename is not None:
+	with open(cart_xml_filename, 'r') as x:
+	    if verbose:
+		print "Restoring CartChunk values from {0}".format(
+			cart_xml_filename)
+	    MyCDPFile.cart.ImportXMLValues(x.read())
+    fields = dict((option, value) for option, value in overrides.iteritems()
+	    if value is not None)
+    MyCDPFile.cart.update(**fields)
+    if verbose:
+	for option, value in sorted(fields.iteritems()):
+	    print "Setting '{0}' to '{1}'".format(option, value)
+    if tagtextinfile is not None:
+	with open(tagtextinfile, 'r') as f:
+	    if verbose:
+		print "Imported TagText from {0}".format(tagtextinfile)
+	    MyCDPFile.cart.tagtext = f.read()
+    if autotimers is not None:
+	timers = MyCDPFile.DetectPostTimers(**autotimers)
+	if timers is None:
+	    if verbose:
+		print "No audio above the silence threshold, post timers" \
+		      " not set"
+	else:
+	    MyCDPFile.cart.posttimers = timers
+	    if verbose:
+		for postcode, sampleval in timers:
+		    if postcode.strip("\x00"):
+			print "Setting post timer '{0}' to {1}".format(
+				postcode, sampleval)
+    #print MyCDPFile
+    results = None
+    if analyze and MyCDPFile.fmt.compressioncode != 1:
+	if verbose:
+	    print "Only PCM audio can be analyzed, skipping analysis"
+	analyze = False
+    if analyze and inplace:
+	results = MyCDPFile.AnalyzePCM()
+    if inplace:
+	audiochanged = MyCDPFile.audioranges is not None
+	if MyCDPFile.UpdateHeadersInPlace(copymethod=copymethod):
+	    if verbose:
+		print "Updated headers in place"
+	elif verbose and audiochanged:
+	    print "Rewrote {0} with the new audio".format(inputfile)
+	elif verbose:
+	    print "Headers did not fit, rewrote {0}".format(inputfile)
+    elif MyCDPFile.fmt.compressioncode == 80:
+	MyCDPFile.WriteCompressedWaveFile(outputfile, copymethod)
+    elif MyCDPFile.fmt.compressioncode == 1:
+	results = MyCDPFile.WritePCMWaveFile(outputfile, copymethod, analyze)
+    else:
+	raise Exception("Incompatible input file type: {0}".format(
+	    inputfile))
+    if results is not None and verbose:
+	print "Loudness: {0:.1f} LUFS, range {1:.1f} LU, true peak {2:.1f}" \
+	      " dBTP, sample peak {3:.1f} dBFS, RMS {4:.1f} dBFS".format(
+	      results["loudness"], results["loudnessrange"],
+	      results["truepeak"], results["samplepeak"], results["rms"])
+    return results
+
+def ReadManifest(manifestfilename):
+    """Yield (line number, row dict) for each file in a CSV or JSONL
+    manifest. Empty values are left out of the row"""
+    with open(manifestfilename, 'rb') as m:
+	if re.match(r'.*\.(jsonl|json)$', manifestfilename, re.I) is not None:
+	    for lineno, line in enumerate(m, 1):
+		if line.strip():
+		    row = json.loads(line)
+		    yield lineno, dict((str(key), value.encode("utf-8")
+			if isinstance(value, unicode) else str(value))
+			for key, value in row.iteritems()
+			if value is not None and value != "")
+	else:
+	    #Line numbers count the header row
+	    for lineno, row in enumerate(csv.DictReader(m), 2):
+		yield lineno, dict((key, value)
+		    for key, value in row.iteritems() if key and value)
+
+def WithoutAppFields(overrides):
+    """Return the overrides without appid and appver, which a restored
+    cart chunk keeps"""
+    return dict((option, value) for option, value in overrides.iteritems()
+	    if option not in ("appid", "appver"))
+
+def BatchWrapFile(job):
+    """Wrap one manifest row and return a status record for the log"""
+    lineno, row, overrides, copymethod, analyze, autotimers = job
+    if "cart" in row:
+	#The restored cart keeps its own producer unless the row sets one
+	overrides = WithoutAppFields(overrides)
+    status = {"line": lineno, "input": row.get("input"),
+	      "output": row.get("output"), "status": "ok"}
+    start_time = time.time()
+    try:
+	if "input" not in row:
+	    raise ValueError("No input file given")
+	fileoverrides = dict(overrides)
+	for column, value in row.iteritems():
+	    if column not in manifestcolumns:
+		if not hasattr(CartChunk(), column):
+		    raise ValueError("Unknown manifest column '{0}'".format(
+			column))
+		fileoverrides[column] = value
+	results = WrapFile(row["input"], row.get("output"), fileoverrides,
+		row.get("cart"), row.get("tagtext"), copymethod,
+		verbose=False, analyze=analyze, autotimers=autotimers)
+	if results is not None:
+	    #JSON has no infinity, so levels of silence are null
+	    status["analysis"] = dict((key, None if value in
+		    (float("inf"), float("-inf")) else value)
+		    for key, value in results.iteritems())
+    except Exception as inst:
+	status["status"] = "error"
+	status["error"] = "{0}: {1}".format(type(inst).__name__, inst)
+    status["seconds"] = round(time.time() - start_time, 3)
+    return status
+
+def BatchWrapFiles(manifestfilename, statuslogfilename, overrides,
+	copymethod="auto", workers=1, analyze=False, autotimers=None):
+    """Run BatchWrapFile over every row of a manifest in a pool of worker
+    processes, writing one JSON status record per file as it finishes.
+    Returns the number of (good, failed) files"""
+    jobs = ((lineno, row, overrides, copymethod, analyze, autotimers)
+	    for lineno, row in ReadManifest(manifestfilename))
+    if workers > 1:
+	pool = multiprocessing.Pool(workers)
+	results = pool.imap_unordered(BatchWrapFile, jobs)
+    else:
+	pool = None
+	results = (BatchWrapFile(job) for job in jobs)
+    good = failed = 0
+    try:
+	with open(statuslogfilename, 'w') as log:
+	    for status in results:
+		log.write(json.dumps(status, sort_keys=True) + "\n")
+		log.flush()
+		if status["status"] == "ok":
+		    good += 1
+		else:
+		    failed += 1
+    finally:
+	if pool is not None:
+	    pool.close()
+	    pool.join()
+    return good, failed
+
+def RestoreCarts(sidecarfilename, verbose=True):
+    """Write the cart chunk of each record in a sidecar back into the file
+    it names, keeping the file's own TagText. Returns the number of
+    (restored, failed) files"""
+    restored = failed = 0
+    for filename, cart in ReadCartSidecar(sidecarfilename):
+	if filename is None:
+	    raise InvalidCartDataError("Sidecar record has no file name")
+	try:
+	    MyCDPFile = CDPFile()
+	    MyCDPFile.ReadWaveFile(filename)
+	    cart.tagtext = MyCDPFile.cart.tagtext
+	    MyCDPFile.cart = cart
+	    MyCDPFile.UpdateHeadersInPlace(filename, ("cart",))
+	    restored += 1
+	    if verbose:
+		print "Restored cart chunk of {0}".format(filename)
+	except (IOError, ValueError) as inst:
+	    failed += 1
+	    if verbose:
+		print "Unable to restore cart chunk of {0}".format(filename)
+		print inst
+    return restored, failed
 
 def main():
     if options.show_version:
 	print "Makecondep Version {0}/Core version {1}".format(program_version,
 		cdpwavefile_core_version)
-	if len(args) != 2:
+	if (len(args) not in (1, 2) and options.manifest is None and
+		options.carts_filename is None):
 	    sys.exit()
-    if len(args) != 2:
+    if options.carts_filename is not None:
+	if len(args) != 0:
+	    parser.error("No input or output files are allowed with"
+		    " --restore-carts")
+	try:
+	    restored, failed = RestoreCarts(options.carts_filename)
+	    print "Restored {0} cart chunks, {1} failed".format(restored,
+		    failed)
+	except (InvalidCartDataError, ValueError) as inst:
+	    print "The cart sidecar could not be read"
+	    print inst
+	except IOError as inst:
+	    print "An IO error occurred"
+	    print inst
+	return
+    #Command line CartChunk values apply to every file
+    overrides = dict((option, value) for option, value in
+	    options.__dict__.iteritems()
+	    if value is not None and hasattr(CartChunk(), option))
+    autotimers = None
+    if options.auto_timers:
+	autotimers = {"threshold": options.silence_threshold,
+		      "gap": options.silence_gap}
+    if options.manifest is not None:
+	if len(args) != 0:
+	    parser.error("No input or output files are allowed in batch mode")
+	if (options.append_files or options.trim_start is not None or
+		options.trim_end is not None):
+	    parser.error("--append, --start and --end are not allowed in"
+		    " batch mode")
+	statuslog = options.status_log or options.manifest + ".log"
+	try:
+	    good, failed = BatchWrapFiles(options.manifest, statuslog,
+		    overrides, options.copy_method, max(1, options.workers),
+		    options.analyze, autotimers)
+	    print "Wrapped {0} files, {1} failed. See {2} for details".format(
+		    good, failed, statuslog)
+	except IOError as inst:
+	    print "An IO error occurred"
+	    print inst
+	return
+    inplace = (len(args) == 1 and
+	    re.match(r'.*\.wav$', args[0], re.I) is not None)
+    if len(args) != 2 and not inplace:
 	parser.error("Input or output file not specified. " 
 		"Try {0} -h for detailed help."
 		.format(os.path.basename(sys.argv[0])))
     inputfile = args[0]
-    outputfile = args[1]
-    MyCDPFile = CDPFile()
-    MyCDPFile.cart.tagtext = ""
+    outputfile = args[-1]
+    if options.cart_xml_filename is not None:
+	overrides = WithoutAppFields(overrides)
     try:
-	if re.match(r'.*\.mp2$', inputfile, re.I) is not None:
-	    MyCDPFile.ImportMpegFile(inputfile)
-	elif re.match(r'.*\.wav$', inputfile, re.I) is not None:
-	    MyCDPFile.ReadWaveFile(inputfile)
-	else:
-	    raise Exception("Unrecognized filename extension on file: {0}".format(
-		inputfile))
-	if options.cart_xml_filename is not None:
-	    with open(options.cart_xml_filename, 'r') as x:
-		print "Restoring CartChunk values from {0}".format(
-			options.cart_xml_filename)
-		MyCDPFile.cart.ImportXMLValues(x.read())
-		options.appid = None
-		options.appver = None
-	for option, value in options.__dict__.iteritems():
-	    if value is not None:
-		try:
-		    getattr(MyCDPFile.cart, option)
-		    setattr(MyCDPFile.cart, option, value)
-		    print "Setting '{0}' to '{1}'".format(option, value)
-		except AttributeError:
-		    pass
-	if options.tagtextinfile is not None:
-	    with open(options.tagtextinfile, 'r') as f:
-		print "Imported TagText from {0}".format(options.tagtextinfile)
-		MyCDPFile.cart.tagtext = f.read()
-	#print MyCDPFile
-	if MyCDPFile.fmt.compressioncode == 80:
-	    MyCDPFile.WriteCompressedWaveFile(outputfile)
-	elif MyCDPFile.fmt.compressioncode == 1:
-	    MyCDPFile.WritePCMWaveFile(outputfile)	
-	else:
-	    raise Exception("Incompatible input file type: {0}".format(
-		inputfile))
+	WrapFile(inputfile, outputfile, overrides, options.cart_xml_filename,
+		options.tagtextinfile, options.copy_method,
+		analyze=options.analyze, autotimers=autotimers,
+		appendfiles=options.append_files or (),
+		start=options.trim_start, end=options.trim_end)
     except InvalidMPEGDataError as inst:
 	print "There was a problem with the MPEG data. " \
 	      "Are you sure it is a valid MP2 audio file with no ID3 tags?"
@@ -136,6 +410,9 @@ def main():
     except IOError as inst:
 	print "An IO error occurred"
 	print inst
+    except InvalidCartDataError as inst:
+	print "The saved cart chunk could not be restored"
+	print inst
     except ValueError as inst:
 	print "Unable to set an attribute value. " \
 	      "Are you sure you entered dates and times in the right format?"
@@ -147,5 +424,5 @@ def main():
 	print inst
 
 if __name__ == "__main__":
+    (options, args) = parser.parse_args()
     main()
-
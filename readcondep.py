@@ -39,11 +39,18 @@
 from cdpwavefile import *
 from optparse import OptionParser
 import sys
+import csv
+import glob
+import json
+import fnmatch
+import itertools
+import multiprocessing
 
 program_version = "1.4"
 
 chunklist = ("cart", "bext", "mext", "fact", "fmt")
-parser = OptionParser(usage="usage: %prog [options] wavefile")
+parser = OptionParser(usage="usage: %prog [options] wavefile\n"
+	"       %prog [options] --scan FOLDER/GLOB...")
 parser.add_option("-v", "--ver", dest="show_version",
 	action="store_true", default=False,
 	help="show program version")
@@ -57,16 +64,214 @@ parser.add_option("--save-cart", dest="cart_xml_filename",
 	help="save cart chunk data to FILE for transfer", metavar="FILE")
 parser.add_option("-x", "--extract-mp2", dest="mp2filename",
 	help="extract MP2 audio to FILE", metavar="FILE")
+parser.add_option("--analyze", dest="analyze", action="store_true",
+	default=False,
+	help="measure and show the loudness and peak levels of PCM audio")
+parser.add_option("--detect-timers", dest="detect_timers",
+	action="store_true", default=False,
+	help="propose post timers from the silent gaps in the audio")
+parser.add_option("--silence-threshold", dest="silence_threshold",
+	type="float", default=silencethreshold,
+	help="treat audio below DB dBFS as silence for --detect-timers,"
+	" default value is {0}".format(silencethreshold), metavar="DB")
+parser.add_option("--silence-gap", dest="silence_gap", type="float",
+	default=silencegap,
+	help="start a new segment after SECONDS of silence for"
+	" --detect-timers, default value is {0}".format(silencegap),
+	metavar="SECONDS")
+parser.add_option("--build-peaks", dest="build_peaks", action="store_true",
+	default=False,
+	help="build the waveform peak file (.pk) next to the audio if it is"
+	" missing or out of date; with --scan, for every PCM file found")
 parser.add_option("--tagtext-out", dest="tagtextoutfile", 
 	help="export TagText value to FILE", metavar="FILE")
-(options, args) = parser.parse_args()
+parser.add_option("--scan", dest="scan", action="store_true",
+	default=False,
+	help="read the headers of every wave file in the given folders"
+	" (searched recursively) and glob patterns")
+parser.add_option("--format", dest="scan_format", default="jsonl",
+	choices=("jsonl", "csv"),
+	help="write scan records as jsonl or csv, default value is jsonl")
+parser.add_option("-o", "--output", dest="scan_output",
+	help="write scan records to FILE instead of the screen",
+	metavar="FILE")
+parser.add_option("--pattern", dest="scan_pattern", default="*.wav",
+	help="only scan files in folders matching PATTERN, default value"
+	" is *.wav")
+parser.add_option("-j", "--workers", dest="workers", type="int",
+	default=multiprocessing.cpu_count(),
+	help="read up to N files at once while scanning, default value is"
+	" the number of CPUs", metavar="N")
+parser.add_option("--ordered", dest="scan_ordered", action="store_true",
+	default=False,
+	help="write scan records in the order the files were found")
+parser.add_option("--save-carts", dest="carts_filename",
+	help="with --scan, save the cart chunk of every file to the XML or"
+	" JSONL (.jsonl) file SIDECAR", metavar="SIDECAR")
+
+def IterWaveFiles(paths, pattern="*.wav"):
+    """Yield the files named by paths, walking folders recursively and
+    expanding glob patterns"""
+    for path in paths:
+	if os.path.isdir(path):
+	    for dirpath, dirnames, filenames in os.walk(path):
+		dirnames.sort()
+		for filename in sorted(filenames):
+		    if fnmatch.fnmatch(filename.lower(), pattern.lower()):
+			yield os.path.join(dirpath, filename)
+	elif os.path.isfile(path):
+	    yield path
+	else:
+	    for filename in sorted(glob.glob(path)):
+		if os.path.isfile(filename):
+		    yield filename
+
+def ScanFile(filename):
+    """Return a dict describing the headers of one wave file"""
+    record = {"path": filename, "size": None, "error": None, "chunks": []}
+    try:
+	record["size"] = os.path.getsize(filename)
+	MyCDPFile = CDPFile()
+	MyCDPFile.ReadWaveFile(filename)
+	record["chunks"] = [[chunktype, offset, chunksize]
+		for chunktype, offset, chunksize in MyCDPFile.chunkmap]
+	record.update(MyCDPFile.ExportFieldDict())
+    except Exception as inst:
+	record["error"] = "{0}: {1}".format(type(inst).__name__, inst)
+    return record
+
+def ScanFiles(filenames, workers=1, ordered=False):
+    """Yield ScanFile records for filenames from a pool of worker
+    processes. Files are handed out a window at a time so memory use
+    does not grow with the number of files"""
+    if workers <= 1:
+	for filename in filenames:
+	    yield ScanFile(filename)
+	return
+    pool = multiprocessing.Pool(workers)
+    try:
+	filenames = iter(filenames)
+	while True:
+	    window = list(itertools.islice(filenames, workers * 64))
+	    if not window:
+		break
+	    if ordered:
+		results = pool.imap(ScanFile, window, 16)
+	    else:
+		results = pool.imap_unordered(ScanFile, window, 16)
+	    for record in results:
+		yield record
+    finally:
+	pool.close()
+	pool.join()
+
+def FlattenRecord(record, columns):
+    """Turn a ScanFile record into a CSV row with the given columns"""
+    row = []
+    for column in columns:
+	if "." in column:
+	    chunkname, field = column.split(".", 1)
+	    value = record.get(chunkname, {}).get(field, "")
+	else:
+	    value = record.get(column, "")
+	if column == "chunks":
+	    value = ";".join("{0}:{1}:{2}".format(*chunk) for chunk in value)
+	elif isinstance(value, list):
+	    value = json.dumps(value)
+	elif value is None:
+	    value = ""
+	row.append(value)
+    return row
+
+def WriteScanRecords(records, outfile, scanformat="jsonl"):
+    """Write ScanFile records to outfile one per line as they arrive and
+    return the number of records written"""
+    count = 0
+    if scanformat == "csv":
+	template = CDPFile().ExportFieldDict()
+	columns = ["path", "size", "error", "chunks"]
+	for chunkname in sorted(template):
+	    columns.extend("{0}.{1}".format(chunkname, field)
+		    for field in sorted(template[chunkname]))
+	writer = csv.writer(outfile)
+	writer.writerow(columns)
+    for record in records:
+	if scanformat == "csv":
+	    writer.writerow(FlattenRecord(record, columns))
+	else:
+	    outfile.write(json.dumps(record, sort_keys=True,
+		encoding="latin-1") + "\n")
+	count += 1
+    return count
+
+def scan():
+    if len(args) == 0:
+	parser.error("No folders or files to scan. Try {0} -h for detailed"
+		" help.".format(os.path.basename(sys.argv[0])))
+    records = ScanFiles(IterWaveFiles(args, options.scan_pattern),
+	    options.workers, options.scan_ordered)
+    if options.scan_output is not None:
+	with open(options.scan_output, "wb") as outfile:
+	    WriteScanRecords(records, outfile, options.scan_format)
+    else:
+	WriteScanRecords(records, sys.stdout, options.scan_format)
+
+def IterCarts(filenames):
+    """Yield (file name, CartChunk) for each file that has a cart chunk"""
+    for filename in filenames:
+	MyCDPFile = CDPFile()
+	try:
+	    foundchunks = MyCDPFile.ReadWaveFile(filename, ("cart",))
+	except Exception as inst:
+	    print "Unable to read {0}, skipping".format(filename)
+	    print inst
+	    continue
+	if "cart" not in foundchunks:
+	    print "No cart chunk in {0}, skipping".format(filename)
+	    continue
+	yield filename, MyCDPFile.cart
+
+def savecarts():
+    if len(args) == 0:
+	parser.error("No folders or files to scan. Try {0} -h for detailed"
+		" help.".format(os.path.basename(sys.argv[0])))
+    count = WriteCartSidecar(options.carts_filename,
+	    IterCarts(IterWaveFiles(args, options.scan_pattern)))
+    print "Saved {0} cart chunks to {1}".format(count, options.carts_filename)
+
+def buildpeaks():
+    if len(args) == 0:
+	parser.error("No folders or files to scan. Try {0} -h for detailed"
+		" help.".format(os.path.basename(sys.argv[0])))
+    built = 0
+    for filename in IterWaveFiles(args, options.scan_pattern):
+	MyCDPFile = CDPFile()
+	try:
+	    MyCDPFile.ReadWaveFile(filename, ("fmt",))
+	    if MyCDPFile.fmt.compressioncode not in (1, 3):
+		continue
+	    MyCDPFile.LoadPeaks()
+	    built += 1
+	except Exception as inst:
+	    print "Unable to build peaks for {0}, skipping".format(filename)
+	    print inst
+    print "Waveform peaks are up to date for {0} files".format(built)
 
 def main():
     if options.show_version:
 	print "Readcondep Version {0}/Core version {1}".format(program_version,
 		cdpwavefile_core_version)
-	if len(args) != 1:
+	if len(args) != 1 and not options.scan:
 	    sys.exit()
+    if options.scan and options.build_peaks:
+	buildpeaks()
+	return
+    if options.scan and options.carts_filename is not None:
+	savecarts()
+	return
+    if options.scan:
+	scan()
+	return
     picked_at_least_one_option = False
     if len(args) != 1:
 	parser.error("Input file not specified. Try {0} -h for detailed help."
@@ -100,6 +305,40 @@ def main():
 			options.tagtextoutfile)
 		f.write(MyCDPFile.cart.tagtext)
 	    picked_at_least_one_option = True
+	if options.analyze:
+	    results = MyCDPFile.AnalyzePCM()
+	    print "--Analysis of PCM audio--"
+	    print "Integrated Loudness: {0:.1f} LUFS".format(
+		    results["loudness"])
+	    print "Loudness Range: {0:.1f} LU".format(
+		    results["loudnessrange"])
+	    print "Max Momentary Loudness: {0:.1f} LUFS".format(
+		    results["maxmomentary"])
+	    print "Max Short Term Loudness: {0:.1f} LUFS".format(
+		    results["maxshortterm"])
+	    print "True Peak: {0:.1f} dBTP".format(results["truepeak"])
+	    print "Sample Peak: {0:.1f} dBFS".format(results["samplepeak"])
+	    print "RMS Level: {0:.1f} dBFS".format(results["rms"])
+	    picked_at_least_one_option = True
+	if options.detect_timers:
+	    timers = MyCDPFile.DetectPostTimers(options.silence_threshold,
+		    options.silence_gap)
+	    print "--Proposed post timers--"
+	    if timers is None:
+		print "No audio above {0} dBFS found".format(
+			options.silence_threshold)
+	    else:
+		for postcode, sampleval in timers:
+		    if postcode.strip("\x00"):
+			print "{0}: {1} ({2:.3f}s)".format(postcode,
+				sampleval,
+				float(sampleval) / MyCDPFile.fmt.samplerate)
+	    picked_at_least_one_option = True
+	if options.build_peaks:
+	    pyramid = MyCDPFile.LoadPeaks()
+	    print "--Waveform peaks in {0}--".format(MyCDPFile.PeakFileName())
+	    print str(pyramid)
+	    picked_at_least_one_option = True
 	if options.mp2filename is not None:
 	    print "Saving MP2 audio to {0}".format(
 		    options.mp2filename)
@@ -127,6 +366,7 @@ def main():
 	print inst
 
 if __name__ == "__main__":
+    (options, args) = parser.parse_args()
     main()
 
 